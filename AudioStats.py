@@ -0,0 +1,107 @@
+import bisect
+import csv
+import os
+import time
+
+class Histogram:
+    """ Fixed bin counter, cheap enough to update from the sound device callback """
+    def __init__(self, edges):
+        self.edges = list(edges) # upper bin limits, values above the last edge go to the overflow bin
+        self.counts = [0] * (len(self.edges) + 1)
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.total += 1
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, q):
+        """ upper edge of the bin holding the q-th percentile, max for the overflow bin """
+        if not self.total:
+            return None
+        rank = q / 100.0 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.edges[i], self.max) if i < len(self.edges) else self.max
+        return self.max
+
+    def summary(self):
+        return {'count': self.total, 'min': self.min, 'p50': self.percentile(50), 'p99': self.percentile(99),
+                'max': self.max, 'edges': self.edges, 'counts': list(self.counts)}
+
+
+class AudioStats:
+    """ Health counters of the audio engine: callback and mixing durations, ring fill level,
+        underruns and the PortAudio status flags reported to the callback """
+    STATUS_FLAGS = ('output_underflow', 'output_overflow', 'priming_output', 'input_underflow', 'input_overflow')
+    TIME_EDGES_US = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000]
+    FILL_EDGES = [i / 20 for i in range(1, 21)] # fraction of the ring holding audio
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.callback_us = Histogram(self.TIME_EDGES_US)
+        self.mix_us = Histogram(self.TIME_EDGES_US)
+        self.fill = Histogram(self.FILL_EDGES)
+        self.status = dict.fromkeys(self.STATUS_FLAGS, 0)
+        self.late_callbacks = 0 # callbacks that took longer than the audio they produced
+
+    def add_callback(self, duration_ns, frames, sample_rate, status):
+        duration_us = duration_ns / 1000
+        self.callback_us.add(duration_us)
+        if duration_us * sample_rate > frames * 1e6:
+            self.late_callbacks += 1
+        if status:
+            for flag in self.STATUS_FLAGS:
+                if getattr(status, flag, False):
+                    self.status[flag] += 1
+
+    def add_mix(self, duration_ns):
+        self.mix_us.add(duration_ns / 1000)
+
+    def add_fill(self, fraction):
+        self.fill.add(fraction)
+
+    def snapshot(self, **counters):
+        return {'callbacks': self.callback_us.total, 'late_callbacks': self.late_callbacks,
+                'status': dict(self.status), 'callback_us': self.callback_us.summary(),
+                'mix_us': self.mix_us.summary(), 'fill': self.fill.summary(), **counters}
+
+
+class StatsLog:
+    """ Periodic CSV rows built from Mixer.stats() """
+    FIELDS = ['time', 'mode', 'callbacks', 'late_callbacks', 'underruns', *AudioStats.STATUS_FLAGS,
+              'callback_p50_us', 'callback_p99_us', 'callback_max_us', 'mix_p50_us', 'mix_p99_us', 'mix_max_us',
+              'fill_min', 'fill_p50', 'latency_ms']
+
+    def __init__(self, file_path, interval=10.0):
+        self.file_path = file_path
+        self.interval = interval
+        self.next_time = time.monotonic() + interval
+
+    def due(self):
+        return time.monotonic() >= self.next_time
+
+    def write(self, stats):
+        self.next_time = time.monotonic() + self.interval
+        row = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'mode': stats['mode'], 'callbacks': stats['callbacks'],
+               'late_callbacks': stats['late_callbacks'], 'underruns': stats['underruns'], **stats['status'],
+               'callback_p50_us': stats['callback_us']['p50'], 'callback_p99_us': stats['callback_us']['p99'],
+               'callback_max_us': stats['callback_us']['max'], 'mix_p50_us': stats['mix_us']['p50'],
+               'mix_p99_us': stats['mix_us']['p99'], 'mix_max_us': stats['mix_us']['max'],
+               'fill_min': stats['fill']['min'], 'fill_p50': stats['fill']['p50'],
+               'latency_ms': round(stats['latency'] * 1000, 2)}
+        new_file = not os.path.exists(self.file_path)
+        with open(self.file_path, 'a', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=self.FIELDS)
+            if new_file:
+                writer.writeheader()
+            writer.writerow(row)
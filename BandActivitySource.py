@@ -0,0 +1,202 @@
+import re
+import numpy as np
+import helpers
+from MorseSoundSource import MorseSoundSource
+
+class Station:
+    """ background station: keyed elements of its current message at absolute sample positions """
+    def __init__(self, next_start):
+        self.elements = [] # (start sample, template), gaps are not stored
+        self.index = 0 # first element that may still sound
+        self.level = 0.0
+        self.next_start = next_start # start of the next message
+
+
+class BandActivitySource:
+    """ A crowded band as a single mixer source: stations at different frequencies, speeds and levels
+        sending calls from the corpus, starting after exponential pauses (Poisson arrivals).
+        Glyph templates come from the shared glyph cache on a coarse frequency/speed grid and only the keyed
+        elements overlapping a block are mixed, so the cost grows with the keyed elements, not the station count """
+    VolumeThreshold = helpers.dB2Amplitude(helpers.L_min) #determines if the source considered active or not
+    MESSAGES = ('CQ TEST {call}', 'CQ {call} {call} TEST', '{call}', '{call} {call}', 'TU {call}', 'QRZ? {call}')
+    CALL = re.compile(r'(?=[A-Z0-9/]*[0-9])(?=[A-Z0-9/]*[A-Z])[A-Z0-9/]+') # letters and at least one digit
+
+    def __init__(self, morse_mapping_filename, stations=8, calls=('NU6N',), frequencies=range(300, 1200, 25),
+                 wpm_range=(18, 40), level_range=(-24, -3), pause=4.0, rise_time=0.1, volume=0.5, sample_rate=44100,
+                 seed=None):
+        """
+        :param stations: number of background stations
+        :param calls: callsigns to send, see set_corpus
+        :param frequencies: candidate tone frequencies, a coarse grid lets stations share glyph templates
+        :param wpm_range: speed range, rounded to whole WPM for the same reason
+        :param level_range: station levels in dB relative to the source volume, scaled down by the square root of
+                            the station count so the band keeps the loudness of a single station
+        :param pause: mean pause between the messages of a station in seconds
+        :param volume: overall volume, applied by the mixer
+        """
+        self.sample_rate = sample_rate
+        self.frequencies = list(frequencies)
+        self.wpm_range = wpm_range
+        self.level_range = level_range
+        self.pause = pause
+        self.default_calls = list(calls)
+        self.calls = self.default_calls
+        self.rng = np.random.default_rng(seed)
+        self.keyer = MorseSoundSource(morse_mapping_filename, wpm=round(wpm_range[0]), frequency=self.frequencies[0],
+                                      sample_rate=sample_rate, rise_time=rise_time, volume=1.0)
+        self.position = 0 # samples rendered so far
+        self.scratch = np.zeros(4096, dtype=np.float32)
+        self._volume = volume
+        self.active = volume > self.VolumeThreshold
+        self.stations = []
+        self.set_stations(stations)
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, in_volume):
+        if in_volume == self._volume:
+            return
+        self._volume = in_volume
+        if self._volume <= self.VolumeThreshold:
+            self.deactivate()
+            return
+        self.activate()
+
+    def deactivate(self):
+        self.active = False
+        self.reset()
+
+    def activate(self):
+        self.active = True
+
+    def set_stations(self, count):
+        self.station_gain = 1 / np.sqrt(max(1, count)) # uncorrelated stations add up in power
+        self.stations = self.stations[:count]
+        while len(self.stations) < count:
+            self.stations.append(Station(self.position + self._pause_samples()))
+
+    def set_corpus(self, data_source, max_calls=5000):
+        """ take the calls of up to max_calls random rows of a loaded DataSource: the call column of call history
+            files, the lines of call lists such as MASTER.SCP. Sources without calls bring back the default calls """
+        msgs = data_source.msgs
+        policy = getattr(msgs, 'policy', None)
+        picks = self.rng.choice(len(msgs), size=min(len(msgs), max_calls), replace=False) if len(msgs) else []
+        if policy is None: # rows are the messages
+            calls = [msgs[int(i)].strip().upper() for i in picks]
+        elif 'call' in policy.format_spec:
+            column = policy.format_spec.index('call')
+            rows = (msgs.row(int(i)).split(',') for i in picks)
+            calls = [fields[column].strip().upper() for fields in rows if len(fields) > column]
+        else:
+            calls = []
+        self.calls = [call for call in calls if self.CALL.fullmatch(call)] or self.default_calls
+
+    def set_rise(self, rise_time):
+        self.keyer.set_rise(rise_time)
+
+    def reset(self, pause=None):
+        """ silence every station, they come back after a fresh pause with the given mean (seconds) """
+        for station in self.stations:
+            station.elements = []
+            station.index = 0
+            station.next_start = self.position + self._pause_samples(pause)
+
+    def _pause_samples(self, pause=None):
+        return int(self.rng.exponential(self.pause if pause is None else pause) * self.sample_rate)
+
+    def _start_message(self, station):
+        call = self.calls[self.rng.integers(len(self.calls))]
+        message = self.MESSAGES[self.rng.integers(len(self.MESSAGES))].format(call=call)
+        keyer = self.keyer
+        keyer.frequency = self.frequencies[self.rng.integers(len(self.frequencies))]
+        wpm = int(self.rng.integers(round(self.wpm_range[0]), round(self.wpm_range[1]) + 1))
+        if keyer.wpm != wpm:
+            keyer.set_speed(wpm) # regenerates the arrays for the new frequency as well
+        else:
+            keyer._generate_arrays()
+        playlist, length = keyer._convert_to_playlist(message.upper())
+        pos = station.next_start
+        station.elements = []
+        for template, samples in playlist:
+            if template is not None:
+                station.elements.append((pos, template))
+            pos += samples
+        station.index = 0
+        station.level = helpers.dB2Amplitude(self.rng.uniform(*self.level_range)) * self.station_gain
+        station.next_start = pos + self._pause_samples()
+
+    def _mix_station(self, station, out, block_start, block_end):
+        elements = station.elements
+        i = station.index
+        audible = False
+        while i < len(elements):
+            start, template = elements[i]
+            if start >= block_end:
+                break
+            end = start + len(template)
+            a, b = max(start, block_start), min(end, block_end)
+            if b > a:
+                segment = self.scratch[:b - a]
+                np.multiply(template[a - start:b - start], station.level, out=segment)
+                out[a - block_start:b - block_start] += segment
+                audible = True
+            if end > block_end: # continues in the next block
+                break
+            i += 1
+        station.index = i
+        return audible
+
+    def get_audio_segment(self, segment_length):
+        segment = np.empty(segment_length, dtype=np.float32)
+        self.render_into(segment, segment_length)
+        return segment
+
+    def render_into(self, out, frames):
+        """ write the next frames samples of band activity into out[:frames], returns frames if anything was keyed """
+        out[:frames] = 0
+        if not self.active:
+            return 0
+        if frames > len(self.scratch):
+            self.scratch = np.zeros(frames, dtype=np.float32)
+        block_start = self.position
+        block_end = block_start + frames
+        audible = False
+        for station in self.stations:
+            while True:
+                audible |= self._mix_station(station, out, block_start, block_end)
+                if station.next_start >= block_end:
+                    break
+                self._start_message(station) # previous message is over, start the next one on its exact sample
+        self.position = block_end
+        return frames if audible else 0
+
+
+if __name__ == "__main__":
+    # Real time factor as the band gets crowded, one core, 0.1 s blocks
+    import time
+    from DataSource import DataSource
+    from MorseSoundSource import glyph_cache
+
+    data_source = DataSource(file_path='data_sources/NAQPCW.txt', policies_file='configs/message_policies.json', num_words=1)
+    out = np.zeros(4410, dtype=np.float32)
+    for stations in (8, 16, 32, 64, 128):
+        band = BandActivitySource('configs/morse_table.json', stations=stations, pause=1.0, seed=1)
+        band.set_corpus(data_source)
+        for _ in range(50): # warm up the glyph cache
+            band.render_into(out, len(out))
+        blocks = 200
+        start = time.perf_counter()
+        keyed = 0
+        peak = 0.0
+        for _ in range(blocks):
+            band.render_into(out, len(out))
+            keyed += sum(1 for s in band.stations if s.index < len(s.elements))
+            peak = max(peak, np.abs(out).max())
+        elapsed = time.perf_counter() - start
+        print(f"{stations:>3} stations: {blocks * len(out) / band.sample_rate / elapsed:6.0f}x real time, "
+              f"{keyed / blocks:5.1f} sending on average, peak {peak:.2f}")
+        assert peak <= 1.0 # the mixer adds the other sources on top
+    print(f"glyph cache {glyph_cache.stats()}")
@@ -1,5 +1,6 @@
 import numpy as np
 import threading
+import time
 
 class CircularBuffer:
     def __init__(self, size, dtype=np.float32):
@@ -50,7 +51,7 @@ class CircularBuffer:
             else:
                 part1_size = self.size - start_index
                 data[:part1_size] = self.buffer[start_index:]
-                data[part1_size:] = self.buffer[:actual_size - part1_size]
+                data[part1_size:actual_size] = self.buffer[:actual_size - part1_size]
 
             self.start = (self.start + actual_size) % self.size
             self.count -= actual_size
@@ -67,9 +68,76 @@ class CircularBuffer:
             return self.count == 0
 
 
-if __name__ == "__main__":
-    import time
+class SPSCRingBuffer:
+    """ Ring for exactly one producer thread and one consumer thread (the sound device callback) without locks.
+        Each side only moves its own counter, the consumer never waits or allocates in get_into """
+    def __init__(self, size, dtype=np.float32, poll_interval=0.001):
+        self.buffer = np.zeros(size, dtype=dtype)
+        self.size = size
+        self.written = 0 # samples ever written, updated by the producer only
+        self.read = 0 # samples ever read, updated by the consumer only
+        self.underruns = 0
+        self.producer_waits = 0 # puts that found the ring full and waited, normal backpressure in push mode
+        self.poll_interval = poll_interval # producer sleep while the ring is full
+
+    @property
+    def count(self):
+        return self.written - self.read
+
+    def put(self, data, stopped=None):
+        """ copy data into the ring, blocks while the ring is full. stopped() is checked while waiting,
+            once it is true put gives up. Returns the number of samples written """
+        data_length = len(data)
+        done = 0
+        waited = False
+        while done < data_length:
+            space_available = self.size - (self.written - self.read)
+            if space_available == 0:
+                if stopped is not None and stopped(): # nobody is going to read the rest
+                    break
+                if not waited:
+                    self.producer_waits += 1
+                    waited = True
+                time.sleep(self.poll_interval)
+                continue
+            chunk_size = min(space_available, data_length - done)
+            end_index = self.written % self.size
+            part1_size = min(chunk_size, self.size - end_index)
+            self.buffer[end_index:end_index + part1_size] = data[done:done + part1_size]
+            self.buffer[:chunk_size - part1_size] = data[done + part1_size:done + chunk_size]
+            self.written += chunk_size # published after the copy
+            done += chunk_size
+        return done
+
+    def get_into(self, out):
+        """ fill out from the ring, missing samples are silence and count as an underrun.
+            Returns the number of samples read """
+        array_size = len(out)
+        actual_size = min(array_size, self.written - self.read)
+        start_index = self.read % self.size
+        part1_size = min(actual_size, self.size - start_index)
+        out[:part1_size] = self.buffer[start_index:start_index + part1_size]
+        out[part1_size:actual_size] = self.buffer[:actual_size - part1_size]
+        if actual_size < array_size:
+            out[actual_size:] = 0
+            self.underruns += 1
+        self.read += actual_size
+        return actual_size
+
+    def get(self, array_size):
+        """ like CircularBuffer.get but never waits, what is missing is silence """
+        data = np.zeros(array_size, dtype=self.buffer.dtype)
+        self.get_into(data)
+        return data
+
+    def is_full(self):
+        return self.count == self.size
 
+    def is_empty(self):
+        return self.count == 0
+
+
+if __name__ == "__main__":
     # Testing part
     N = 100000
     L = 3000  # Set the maximum value for chunk_size
@@ -85,7 +153,7 @@ if __name__ == "__main__":
             # Generate an array with length between 1 and the smaller of chunk_size or remaining numbers
             remaining = N - i
             length = min(np.random.randint(1, chunk_size + 1), remaining)
-            data = np.arange(i, i + length)
+            data = np.arange(i + 1, i + length + 1) # zero is reserved for silence
             buffer.put(data)
             i += length
 
@@ -96,8 +164,11 @@ if __name__ == "__main__":
             if error_flag.is_set():
                 break
             
-            data = buffer.get(chunk_size)
-            expected_chunk = np.arange(current_index, current_index + len(data))
+            data = np.trim_zeros(buffer.get(chunk_size), 'b') # both classes pad a short read with silence
+            if not len(data):
+                time.sleep(0) # let the producer run
+                continue
+            expected_chunk = np.arange(current_index + 1, current_index + len(data) + 1)
             
             if not np.array_equal(data, expected_chunk):
                 print(f"Test failed! Expected chunk: {expected_chunk}, Failed chunk: {data}")
@@ -113,10 +184,10 @@ if __name__ == "__main__":
 
     chunk_sizes = np.linspace(1, L, K, dtype=int)
 
-    for chunk_size in chunk_sizes:
-        print(f"Running test with chunk_size = {chunk_size}")
+    for buffer_class, chunk_size in [(c, s) for c in (CircularBuffer, SPSCRingBuffer) for s in chunk_sizes]:
+        print(f"Running {buffer_class.__name__} test with chunk_size = {chunk_size}")
         start_time = time.time()
-        circular_buffer = CircularBuffer(buffer_size)
+        circular_buffer = buffer_class(buffer_size)
         error_flag = threading.Event()
         #stop_event = threading.Event()
 
@@ -146,3 +217,34 @@ if __name__ == "__main__":
         else:
             print(f"Test failed with chunk_size = {chunk_size}.")
             break
+
+    # Throughput and tail latency of the consumer side with audio sized blocks: the producer puts mixer blocks,
+    # the consumer reads sound device blocks as fast as it can and times every read
+    def timed_consumer(buffer, total, frames, durations):
+        out = np.empty(frames, dtype=np.float32)
+        received = 0
+        while received < total:
+            start = time.perf_counter_ns()
+            if isinstance(buffer, SPSCRingBuffer):
+                buffer.get_into(out)
+            else:
+                out[:] = buffer.get(frames)
+            durations.append(time.perf_counter_ns() - start)
+            received += np.count_nonzero(out)
+
+    total = 60 * 44100
+    block = np.ones(4410, dtype=np.float32)
+    for buffer_class in (CircularBuffer, SPSCRingBuffer):
+        ring = buffer_class(44100)
+        durations = []
+        consumer_thread = threading.Thread(target=timed_consumer, args=(ring, total, 512, durations))
+        start_time = time.perf_counter()
+        consumer_thread.start()
+        for _ in range(total // len(block)):
+            ring.put(block)
+        consumer_thread.join()
+        elapsed = time.perf_counter() - start_time
+        p50, p99, p999 = np.percentile(durations, [50, 99, 99.9]) / 1000
+        underruns = f", {ring.underruns} underruns" if isinstance(ring, SPSCRingBuffer) else ""
+        print(f"{buffer_class.__name__}: {total / elapsed / 1e6:.1f} M samples/s, get latency p50 {p50:.1f} us, "
+              f"p99 {p99:.1f} us, p99.9 {p999:.1f} us, max {max(durations) / 1000:.0f} us{underruns}")
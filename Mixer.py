@@ -1,51 +1,262 @@
 import numpy as np
-import sounddevice as sd
+import heapq
+import itertools
 import threading
-from CircularBuffer import CircularBuffer
-from time import sleep
+from collections import deque
+from AudioStats import AudioStats, StatsLog
+from CircularBuffer import SPSCRingBuffer
+from time import sleep, perf_counter_ns
+from helpers import log
+
+class GainRamp:
+    """ Source gain that follows volume changes with a short linear ramp to avoid clicks """
+    def __init__(self, gain, ramp):
+        self.ramp = ramp # precomputed 1/n .. 1 ramp shared by all sources
+        self.start = gain
+        self.target = gain
+        self.pos = len(ramp)
+
+    @property
+    def value(self):
+        if self.pos >= len(self.ramp):
+            return self.target
+        if self.pos == 0:
+            return self.start
+        return self.start + (self.target - self.start) * float(self.ramp[self.pos - 1])
+
+    def set(self, target):
+        if target != self.target:
+            self.start = self.value
+            self.target = target
+            self.pos = 0
+
+    def skip(self, frames):
+        """ advance the ramp over a block that contributes nothing to the mix """
+        self.pos = min(len(self.ramp), self.pos + frames)
+
+    def is_silent(self):
+        return self.target == 0.0 and self.pos >= len(self.ramp)
+
+    def mix(self, segment, mixed_audio, scratch):
+        """ mixed_audio += gain * segment, segment is scaled in place and scratch holds the ramp """
+        ramped = max(0, min(len(segment), len(self.ramp) - self.pos))
+        if ramped:
+            ramp = scratch[:ramped]
+            np.multiply(self.ramp[self.pos:self.pos + ramped], self.target - self.start, out=ramp)
+            ramp += self.start
+            segment[:ramped] *= ramp
+            self.pos += ramped
+        if ramped < len(segment):
+            segment[ramped:] *= self.target
+        mixed_audio += segment
+
 
 class Mixer:
-    def __init__(self, sample_rate=44100, interval=0.1):
+    PUSH = 'push' # mixing thread fills the ring ahead of the sound device
+    PULL = 'pull' # blocks are mixed on demand inside the sound device callback
+
+    def __init__(self, sample_rate=44100, interval=0.1, ramp_time=0.01, mode=PUSH, latency=0.02,
+                 stats_file=None, stats_interval=10.0):
+        """
+        :param interval: block duration mixed ahead of time in push mode
+        :param ramp_time: duration of the gain ramp applied on volume changes
+        :param mode: Mixer.PUSH or Mixer.PULL
+        :param latency: output latency target in seconds for pull mode (0.01 - 0.05 are reasonable)
+        :param stats_file: csv file that gets a row of stats() every stats_interval seconds while playing
+        """
+        if mode not in (self.PUSH, self.PULL):
+            raise ValueError(f"Unknown mixer mode {mode}")
         self.sources = []
+        self.gains = []
         self.interval = interval
         self.sample_rate = sample_rate
+        self.mode = mode
+        self.latency_target = latency
         self.playing = False
-        self.queue = CircularBuffer(self.sample_rate)  # Limit the queue size to prevent excessive memory usage
+        self.queue = SPSCRingBuffer(self.sample_rate)  # one second ahead at most, the device callback never waits on it
         self.interval_samples = int(self.interval * sample_rate)
+        # pull mode: half of the latency budget per callback block, the rest is left to the device
+        self.blocksize = max(64, int(self.latency_target * sample_rate / 2))
+        ramp_samples = max(1, int(ramp_time * sample_rate))
+        self.ramp = np.arange(1, ramp_samples + 1, dtype=np.float32) / ramp_samples
+        self._allocate_buffers(max(self.interval_samples, self.blocksize))
+        self.output_delay = 0.0 # device delay reported by the stream, seconds
+        self.measured_latency = 0.0 # smoothed end-to-end latency, seconds
+        self.audio_stats = AudioStats()
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.clock = 0 # samples mixed so far, the time base of scheduled events
+        self._events = [] # heap of (sample, id, source, prepared message, repeat), owned by the mixing side
+        self._incoming = deque() # new events from other threads, moved into the heap before each block
+        self._cancelled = set()
+        self._event_ids = itertools.count(1)
         self.mixing_thread = None
         self.playing_thread = None
 
+    def _allocate_buffers(self, size):
+        # preallocated float32 work buffers, the steady state mixing does not allocate
+        self.mix_buffer = np.zeros(size, dtype=np.float32)
+        self.gain_buffer = np.zeros(size, dtype=np.float32)
+        # one row per source: steady sources fill it from the top and are reduced with a single dot product,
+        # sources in a gain ramp fill it from the bottom and are mixed one by one
+        self.stack = np.zeros((max(1, len(self.sources)), size), dtype=np.float32)
+        self.gain_vector = np.zeros(len(self.stack), dtype=np.float32)
+
     def add_source(self, sound_source):
         self.sources.append(sound_source)
+        self.gains.append(GainRamp(getattr(sound_source, 'volume', 1.0) if getattr(sound_source, 'active', True) else 0.0, self.ramp))
+        if len(self.sources) > len(self.stack):
+            self._allocate_buffers(len(self.mix_buffer))
 
     def start(self):
         if self.playing:
             return
         self.playing = True
-        self.mixing_thread = threading.Thread(target=self._mix_audio)
+        self.measured_latency = 0.0
+        self.audio_stats.reset()
+        self.queue.underruns = self.queue.producer_waits = 0
+        if self.mode == self.PUSH:
+            self.mixing_thread = threading.Thread(target=self._mix_audio)
+            self.mixing_thread.start()
         self.playing_thread = threading.Thread(target=self._play_audio)
-        self.mixing_thread.start()
         self.playing_thread.start()
 
+    def schedule(self, source, message, at_sample_offset, repeat=None):
+        """ start message on a MorseSoundSource at_sample_offset samples after the current mixer clock,
+            with repeat (samples) it is sent again every repeat samples. Returns an id for cancel().
+            The message is converted here, in pull mode the audio callback only queues it """
+        event_id = next(self._event_ids)
+        prepared = source.prepare(message)
+        self._incoming.append((self.clock + max(0, int(at_sample_offset)), event_id, source, prepared, repeat))
+        return event_id
+
+    def cancel(self, event_id):
+        self._cancelled.add(event_id)
+
+    def clear_schedule(self):
+        self._incoming.clear()
+        self._events.clear()
+        self._cancelled.clear()
+
+    def _run_events(self, frames):
+        # messages starting inside this block are queued with the silence that puts them on their exact sample
+        while self._incoming:
+            heapq.heappush(self._events, self._incoming.popleft())
+        block_end = self.clock + frames
+        while self._events and self._events[0][0] < block_end:
+            at, event_id, source, prepared, repeat = heapq.heappop(self._events)
+            if event_id in self._cancelled:
+                self._cancelled.discard(event_id)
+                continue
+            source.play_prepared(prepared, delay_samples=at - self.clock, block=False)
+            if repeat:
+                heapq.heappush(self._events, (at + int(repeat), event_id, source, prepared, repeat))
+
+    def _mix_block(self, frames=None):
+        start = perf_counter_ns()
+        if frames is None:
+            frames = self.interval_samples
+        if self._events or self._incoming:
+            self._run_events(frames)
+        if frames > len(self.mix_buffer): # device asked for a larger block than planned
+            self._allocate_buffers(frames)
+        mixed_audio = self.mix_buffer[:frames]
+        steady = 0 # rows from the top of the stack
+        ramping = [] # gains of the rows from the bottom of the stack
+        for source, gain in zip(self.sources, self.gains):
+            gain.set(getattr(source, 'volume', 1.0) if getattr(source, 'active', True) else 0.0) # volume changes are picked up here
+            if gain.is_silent():
+                continue
+            in_ramp = gain.pos < len(gain.ramp)
+            row = self.stack[-1 - len(ramping) if in_ramp else steady, :frames]
+            render_into = getattr(source, 'render_into', None)
+            if render_into is None: # third party source, only get_audio_segment is available
+                row[:] = source.get_audio_segment(frames)
+            elif render_into(row, frames) == 0: # idle source, sources returning None are always mixed
+                gain.skip(frames)
+                continue
+            if in_ramp:
+                ramping.append(gain)
+            else:
+                self.gain_vector[steady] = gain.target
+                steady += 1
+        if steady:
+            np.dot(self.gain_vector[:steady], self.stack[:steady, :frames], out=mixed_audio)
+        else:
+            mixed_audio.fill(0)
+        for i, gain in enumerate(ramping): # rare, only right after a volume change
+            gain.mix(self.stack[-1 - i, :frames], mixed_audio, self.gain_buffer)
+        self.clock += frames
+        self.audio_stats.add_mix(perf_counter_ns() - start)
+        return mixed_audio
+
     def _mix_audio(self):
+        stopped = lambda: not self.playing # a full ring is not drained once playback is over or failed
         while self.playing:
-            mixed_audio = np.zeros(self.interval_samples)
-            for source in self.sources:
-                if not source.active:
-                    continue
-                audio_segment = source.get_audio_segment(self.interval_samples)
-                #if mixed_audio.shape == audio_segment.shape:
-                mixed_audio += audio_segment
-            self.queue.put(mixed_audio)
+            self.queue.put(self._mix_block(), stopped) # put copies the block into the ring
+
+    def _update_latency(self, time, buffered_frames):
+        # audio queued ahead of the block plus the time until the block reaches the DAC
+        self.output_delay = max(0.0, time.outputBufferDacTime - time.currentTime)
+        latency = self.output_delay + float(buffered_frames) / self.sample_rate
+        self.measured_latency = latency if not self.measured_latency else 0.9 * self.measured_latency + 0.1 * latency
+
+    def latency(self):
+        """ measured end-to-end latency in seconds: from a source change to the sound leaving the device """
+        return self.measured_latency
+
+    def stats(self):
+        """ engine health since start(): callback and mix durations (us), ring fill level, underruns
+            and PortAudio status flag counts. Underruns are ring events, pull mode has no ring """
+        return self.audio_stats.snapshot(mode=self.mode, underruns=self.queue.underruns, latency=self.measured_latency)
+
+    def render(self, frames):
+        """ mix the next frames samples without a sound device (offline rendering),
+            the returned block is reused by the next call """
+        return self._mix_block(frames)
 
     def _play_audio(self):
-        def callback(outdata, frames, time, status):
-            outdata[:] = self.queue.get(frames).reshape(-1, 1)
+        try:
+            self._run_stream()
+        except Exception as e:
+            self.playing = False # lets the mixing thread and stop() finish
+            log('error', f"Mixer playback failed: {e!r}")
+
+    def _run_stream(self):
+        import sounddevice as sd # only needed for playback, offline rendering works without PortAudio
+
+        def push_callback(outdata, frames, time, status):
+            start = perf_counter_ns()
+            self.queue.get_into(outdata[:, 0]) # silence on underrun
+            self._update_latency(time, self.queue.count + frames)
+            self.audio_stats.add_fill(self.queue.count / self.queue.size)
+            self.audio_stats.add_callback(perf_counter_ns() - start, frames, self.sample_rate, status)
 
-        with sd.OutputStream(samplerate=self.sample_rate, channels=1, dtype='float32', callback=callback):
-            while self.playing or not self.queue.is_empty():
+        def pull_callback(outdata, frames, time, status):
+            start = perf_counter_ns()
+            outdata[:, 0] = self._mix_block(frames)
+            self._update_latency(time, frames)
+            self.audio_stats.add_callback(perf_counter_ns() - start, frames, self.sample_rate, status)
+
+        stats_log = StatsLog(self.stats_file, self.stats_interval) if self.stats_file else None
+
+        if self.mode == self.PULL:
+            stream = sd.OutputStream(samplerate=self.sample_rate, channels=1, dtype='float32', callback=pull_callback,
+                                     blocksize=self.blocksize, latency=self.latency_target)
+        else:
+            stream = sd.OutputStream(samplerate=self.sample_rate, channels=1, dtype='float32', callback=push_callback)
+        with stream:
+            while self.playing or (self.mode == self.PUSH and not self.queue.is_empty()):
                 sleep(0.001)  # Keep the main thread alive and responsive
+                if stats_log and stats_log.due():
+                    stats_log.write(self.stats())
         sd.stop()
+        if stats_log:
+            stats_log.write(self.stats())
+        stats = self.stats()
+        log('debug', f"Mixer {self.mode} mode: end-to-end latency {1000 * self.measured_latency:.1f} ms, "
+                     f"{stats['underruns']} underruns, {stats['late_callbacks']} late callbacks, "
+                     f"callback p99 {stats['callback_us']['p99']} us, status flags {stats['status']}")
 
     def stop(self):
         self.playing = False
@@ -53,3 +264,109 @@ class Mixer:
             self.mixing_thread.join()
         if self.playing_thread:
             self.playing_thread.join()
+        self.clear_schedule()
+
+
+if __name__ == "__main__":
+    # Steady state allocations of the mixing path, in allocations per second of audio
+    import inspect
+    import time
+    import timeit
+    import tracemalloc
+    from MorseSoundSource import MorseSoundSource
+    from NoiseSoundSource import NoiseSoundSource, BandNoiseGenerator
+
+    sample_rate = 44100
+    mixer = Mixer(sample_rate=sample_rate)
+    morse = MorseSoundSource('configs/morse_table.json', wpm=30, sample_rate=sample_rate)
+    mixer.add_source(morse)
+    mixer.add_source(NoiseSoundSource(audio_segment=np.random.normal(0, 0.3, sample_rate), sample_rate=sample_rate, initial_volume=0.3))
+    mixer.add_source(NoiseSoundSource(generator=BandNoiseGenerator(sample_rate=sample_rate), sample_rate=sample_rate, initial_volume=0.3))
+    mixer.add_source(MorseSoundSource('configs/morse_table.json', wpm=20, sample_rate=sample_rate)) # idle station is skipped
+    for _ in range(20):
+        morse.play_string("cq test nu6n")
+    # Allocations made while mixing, per traceback. Python ints (<= 32 bytes) of the counters come and go with
+    # the values they reach and are left out, numpy data buffers count at any size. The largest per block peak
+    # catches temporaries freed within the block, none may be as large as a block
+    source_lines, first_line = inspect.getsourcelines(Mixer._mix_block)
+    mix_lines = range(first_line, first_line + len(source_lines))
+    block_bytes = mixer.interval_samples * np.dtype(np.float32).itemsize
+    warm_up, blocks = 300, 300
+    largest = 0
+    tracemalloc.start(50) # deep enough to see the _mix_block frame below every allocation
+    for i in range(warm_up + blocks): # numpy caches its ufunc buffers on the first gain ramp, warm up includes ramps
+        if i == warm_up:
+            before = tracemalloc.take_snapshot()
+            largest = 0
+        if i % 50 == 0:
+            morse.volume = 0.3 if morse.volume == 0.5 else 0.5 # exercise the gain ramp
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        mixer._mix_block()
+        largest = max(largest, tracemalloc.get_traced_memory()[1] - baseline)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    def mixing_growth(before, after):
+        return [stat for stat in after.compare_to(before, 'traceback') if stat.count_diff > 0 and
+                any(frame.filename == __file__ and frame.lineno in mix_lines for frame in stat.traceback)]
+
+    numpy_buffers = [tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)]
+    allocated = [stat for stat in mixing_growth(before, after) if stat.size_diff > 32 * stat.count_diff]
+    allocated += mixing_growth(before.filter_traces(numpy_buffers), after.filter_traces(numpy_buffers))
+    count = sum(stat.count_diff for stat in allocated)
+    audio_seconds = blocks * mixer.interval_samples / sample_rate
+    print(f"mixing allocations: {count / audio_seconds:.1f} per second of audio, "
+          f"largest transient {largest} bytes per block (block {block_bytes} bytes)")
+    for stat in allocated:
+        print(stat, *stat.traceback.format(), sep='\n')
+    assert not allocated and largest < block_bytes
+
+    start = time.perf_counter()
+    for _ in range(blocks):
+        mixer._mix_block()
+    elapsed = time.perf_counter() - start
+    print(f"mixing: {audio_seconds / elapsed:.0f}x real time")
+
+    # Pileup scaling: one dot product over the station stack vs. the former per station multiply-add
+    def per_station_mix(mixer, frames, mixed, buffer):
+        mixed.fill(0)
+        for source, gain in zip(mixer.sources, mixer.gains):
+            gain.set(getattr(source, 'volume', 1.0) if getattr(source, 'active', True) else 0.0)
+            if gain.is_silent() or source.render_into(buffer, frames) == 0:
+                continue
+            gain.mix(buffer, mixed, mixer.gain_buffer)
+
+    frames = 512 # a low latency pull mode block
+    mixed, buffer = np.zeros(frames, dtype=np.float32), np.zeros(frames, dtype=np.float32)
+    for stations in (1, 2, 4, 8, 16, 32, 64):
+        mixers = []
+        for _ in range(2):
+            mixer = Mixer(sample_rate=sample_rate)
+            for i in range(stations):
+                station = MorseSoundSource('configs/morse_table.json', wpm=20 + i % 20, frequency=400 + 10 * i,
+                                           sample_rate=sample_rate, volume=0.3)
+                station.play_string('cq test de nu6n ' * 10)
+                mixer.add_source(station)
+            mixers.append(mixer)
+        t_loop = min(timeit.repeat(lambda: per_station_mix(mixers[0], frames, mixed, buffer), number=50, repeat=3)) / 50
+        t_stack = min(timeit.repeat(lambda: mixers[1]._mix_block(frames), number=50, repeat=3)) / 50
+        print(f"{stations:>2} stations: per station {1e6 * t_loop:7.1f} us/block, stacked {1e6 * t_stack:7.1f} us/block, "
+              f"speedup {t_loop / t_stack:4.2f}x, {frames / sample_rate / t_stack:6.0f}x real time")
+
+    # End-to-end latency in both engine modes, needs a sound device
+    for mode in (Mixer.PUSH, Mixer.PULL):
+        mixer = Mixer(sample_rate=sample_rate, mode=mode, latency=0.02)
+        mixer.add_source(morse)
+        mixer.start()
+        morse.play_string("vvv")
+        time.sleep(2)
+        if not mixer.playing: # the playback thread failed, stop() still has to return
+            mixer.stop()
+            print(f"{mode} mode: no sound device")
+            continue
+        stats = mixer.stats()
+        print(f"{mode} mode: end-to-end latency {1000 * mixer.latency():.1f} ms, {stats['underruns']} underruns, "
+              f"callback p99 {stats['callback_us']['p99']} us, mix p99 {stats['mix_us']['p99']} us, "
+              f"status flags {stats['status']}")
+        mixer.stop()
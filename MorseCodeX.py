@@ -8,19 +8,19 @@ if platform.system() == 'Darwin':
 else:
     Button = tk.Button
     gLeftButton = '<ButtonRelease-3>'
-import threading
 import os
 import sys
 from datetime import datetime, timedelta
 import shelve
 from SessionDB import Session, SessionDB
-from NoiseSoundSource import NoiseSoundSource
+from NoiseSoundSource import NoiseSoundSource, BandNoiseGenerator
 from Mixer import Mixer
 from MorseSoundSource import MorseSoundSource
+from BandActivitySource import BandActivitySource
 from DataSource import DataSource
+from VirtualTreeview import VirtualTreeview
 import numpy as np
 import helpers
-import time
 import csv
 from helpers import log
     
@@ -51,29 +51,30 @@ class MorseCodeXUI:
         if not os.path.exists(os.path.join(self.config_path, 'qrn.wav')):
             log("error", "qrn.wav file was not found")
             sys.exit()
-        audio_segment, self.sample_rate = helpers.read_wav(os.path.join(self.config_path, 'qrn.wav')) # this file will govern sample rate
-        self.player = Mixer(sample_rate=self.sample_rate)
+        qrn_wav = helpers.WavReader(os.path.join(self.config_path, 'qrn.wav')) # this file will govern sample rate
+        self.sample_rate = qrn_wav.sample_rate
+        stats_file = os.path.join(self.config_path, 'audio_stats.csv') if self.audio_stats_log else None
+        self.player = Mixer(sample_rate=self.sample_rate, mode=self.audio_mode, latency=self.audio_latency,
+                            stats_file=stats_file)
         self.morse_file = os.path.join(self.config_path, "morse_table.json")
         self.morse_sources = [MorseSoundSource(morse_mapping_filename = self.morse_file, wpm=self.init_speed.get(), frequency=self.frequency, rise_time=self.rise_time, volume=self.cw_volume)]
         self.player.add_source(self.morse_sources[0])
 
-        qrm_freq = np.random.choice([*range(100, 360, 20), *range(900, 1060, 20)])
-        self.qrm_source = MorseSoundSource(morse_mapping_filename = self.morse_file, wpm=35, frequency=qrm_freq, rise_time=self.rise_time, volume=self.qrm_volume, queue_sz=1)
+        # background stations stay off the training tone
+        self.qrm_source = BandActivitySource(self.morse_file, stations=self.qrm_stations, frequencies=[*range(100, 360, 20), *range(900, 1060, 20)],
+                                             rise_time=self.rise_time, volume=self.qrm_volume, sample_rate=self.sample_rate)
         self.player.add_source(self.qrm_source)
         
-        noise_duration=float(len(audio_segment))/self.sample_rate
-        self.qrn_source = NoiseSoundSource(audio_segment=audio_segment, sample_rate=self.sample_rate, 
+        noise_duration=float(len(qrn_wav))/self.sample_rate
+        self.qrn_source = NoiseSoundSource(audio_segment=qrn_wav, sample_rate=self.sample_rate, 
                                        duration=noise_duration, initial_volume=self.qrn_volume)
         self.player.add_source(self.qrn_source)  # qrn.wav
-        white_noise = np.random.normal(0, 1.0, int(self.sample_rate * noise_duration))
-        white_noise = helpers.band_pass_filter(white_noise, sampling_rate=self.sample_rate)
-        self.hfnoise_source = NoiseSoundSource(audio_segment=white_noise, duration=noise_duration, 
+        self.hfnoise_source = NoiseSoundSource(generator=BandNoiseGenerator(sample_rate=self.sample_rate),
                                                 sample_rate=self.sample_rate, initial_volume=self.hfnoise_volume)
         self.player.add_source(self.hfnoise_source)
         
         self.start_enabled = True
         self.speed_increase = True
-        self.qrm_thread = []
         self.create_start_screen()
         self.msgs = []
     
@@ -97,12 +98,17 @@ class MorseCodeXUI:
             self.generate_rst = tk.BooleanVar(value=settings.get('rst', False))
             self.qrn_volume = settings.get('qrn_volume', 0)
             self.qrm_volume = settings.get('qrm_volume', 0)
+            self.qrm_stations = settings.get('qrm_stations', 8)
+            self.random_access_size = settings.get('random_access_size', 16 * 1024 * 1024) # larger data files are read by line index
             self.sort_by = settings.get('sort_by', 'score')
             self.sort_inverted = settings.get('sort_inverted', False)
             self.signal_cnt = tk.IntVar(value = settings.get('signal_cnt', 1))
             self.timing_spread = tk.DoubleVar(value=settings.get('timing_spread', 0.2))
             self.randomize_speed = tk.BooleanVar(value=settings.get('randomize_speed', False))
             self.randomize_tone = tk.BooleanVar(value=settings.get('randomize_tone', False))
+            self.audio_mode = settings.get('audio_mode', Mixer.PUSH)
+            self.audio_latency = settings.get('audio_latency', 0.02)
+            self.audio_stats_log = settings.get('audio_stats_log', False) # audio_stats.csv for slow machines
 
     def save_settings(self):
         with shelve.open(os.path.join(self.config_path,'settings')) as settings:
@@ -122,6 +128,8 @@ class MorseCodeXUI:
             settings['ser_num'] = self.generate_ser_num.get()
             settings['rst'] = self.generate_rst.get()
             settings['qrm_volume'] = self.qrm_source.volume
+            settings['qrm_stations'] = len(self.qrm_source.stations)
+            settings['random_access_size'] = self.random_access_size
             settings['qrn_volume'] = self.qrn_source.volume 
             settings['sort_by'] = self.sort_by
             settings['sort_inverted'] = self.sort_inverted
@@ -129,6 +137,9 @@ class MorseCodeXUI:
             settings['timing_spread'] = self.timing_spread.get()
             settings['randomize_speed'] = self.randomize_speed.get()
             settings['randomize_tone'] = self.randomize_tone.get()
+            settings['audio_mode'] = self.audio_mode
+            settings['audio_latency'] = self.audio_latency
+            settings['audio_stats_log'] = self.audio_stats_log
             
     def create_start_screen(self):
         for widget in self.root.winfo_children():
@@ -369,22 +380,17 @@ class MorseCodeXUI:
         self.root.bind(self.kbd_shortcuts['repeat'][0], lambda event: self.play_word(delay=1, replay=True))
         self.load_challenges()
 
-        self.data_source = DataSource(file_path=os.path.join(self.data_source_dir, self.data_source_file.get()), num_words=int(self.training_word_count.get() * self.signal_cnt.get()), 
+        source_file = os.path.join(self.data_source_dir, self.data_source_file.get())
+        large_file = os.path.exists(source_file) and os.path.getsize(source_file) > self.random_access_size
+        self.data_source = DataSource(file_path=source_file, num_words=int(self.training_word_count.get() * self.signal_cnt.get()), 
                                       pre_message=self.pre_msg_chk.get(), rst = self.generate_rst.get(), serial=self.generate_ser_num.get(),
                                       challenges=self.challenges, challenge_frac=0.25, 
-                                      policies_file = os.path.join(self.config_path,  'message_policies.json'))
+                                      policies_file = os.path.join(self.config_path,  'message_policies.json'),
+                                      cache_dir=os.path.join(self.config_path, 'cache'), random_access=large_file)
         self.player.start()
         self.morse_sources[0].play_string("vvv")
         self.play_word(3)
-        self.run_qrm_thread = True # yes, always start. when qrm_source is inactive play_string does nothing, thus thread will be mostly idle(for now)
-        def qrm_sender():
-            self.qrm_source.play_string("cq test nu6n")
-            time.sleep(5)
-            while(self.run_qrm_thread):
-                self.qrm_source.play_string()
-                time.sleep(6)
-        self.qrm_thread = threading.Timer(3, qrm_sender)
-        self.qrm_thread.start()
+        self.qrm_source.set_corpus(self.data_source) # background stations send calls from the same file
   
 
     def update_softness(self, event):
@@ -404,48 +410,52 @@ class MorseCodeXUI:
         return int(500 + (1.0 - float(self.tone)/100) * 350) # 500-850 hz
 
     def load_challenges(self):
-        # open challenges record
-        self.challenge_file, _ = os.path.splitext(self.data_source_file.get())
-        self.challenge_file += '.chg'
+        # challenge counts of the source from sessions.db
         self.challenges = {}
         if not self.use_challenge.get():
             return
+        self.import_challenge_file()
+        self.challenges = self.session_db.get_challenges(self.data_source_file.get())
+
+    def import_challenge_file(self):
+        # challenges used to be kept in <source>.chg, moved into sessions.db on first use
+        challenge_file, _ = os.path.splitext(self.data_source_file.get())
+        challenge_file = os.path.join(self.data_source_dir, challenge_file + '.chg')
+        if not os.path.exists(challenge_file):
+            return
+        challenges = {}
         try:
-            with open(os.path.join(self.data_source_dir, self.challenge_file), mode = "r") as challenge_db:
+            with open(challenge_file, mode = "r") as challenge_db:
                 reader = csv.reader(challenge_db)
                 for row in reader:
                     if not row:
                         continue
                     key, val = row
-                    self.challenges[key] = int(val)
-        except FileNotFoundError:
-            pass #legit condition
+                    challenges[key] = int(val)
+            self.session_db.import_challenges(self.data_source_file.get(), challenges)
+            os.replace(challenge_file, challenge_file + '.imported')
         except Exception as e:
             log('error', f"An error occurred: {e}")
 
-    def save_challenges(self):
-    # clean and save challenges
-        if not self.use_challenge.get():
-            return
-        with open(os.path.join(self.data_source_dir, self.challenge_file), mode="w") as challenges_db:
-            writer = csv.writer(challenges_db)
-            for key, value in self.challenges.items():
-                if value < 0:
-                    continue
-                writer.writerow([key, value])
+    def update_challenge(self, sent_text, delta):
+        errors = self.session_db.update_challenge(self.data_source_file.get(), sent_text, delta)
+        if errors < 0:
+            self.challenges.pop(sent_text, None)
+        else:
+            self.challenges[sent_text] = errors
+        self.data_source.update_challenge(sent_text, errors)
 
     def remove_challenge(self, sent_text):
         if not self.use_challenge.get():
             return
         if sent_text in self.challenges:
-            self.challenges[sent_text] = self.challenges[sent_text] - 1
+            self.update_challenge(sent_text, -1)
 
     def add_challenge(self, sent_text):
         if self.use_challenge.get():
-            self.challenges[sent_text] = self.challenges.get(sent_text, 0) + 1
+            self.update_challenge(sent_text, 1)
 
     def create_session_results_screen(self):
-        self.save_challenges()
         if self.current_session is None:
             messagebox.showerror("Error", "No current session available")
             return
@@ -472,7 +482,11 @@ class MorseCodeXUI:
         self.session_frame = ttk.Frame(self.root)
         self.session_frame.pack(fill=tk.BOTH, expand=True)
 
-        self.tree = ttk.Treeview(self.session_frame, columns=('score', 'date', 'source'), show='headings')
+        # only the sessions in view are in the tree, session headers are read page by page while scrolling
+        self.session_view = VirtualTreeview(self.session_frame, columns=('score', 'date', 'source'),
+                                            count=self.session_db.count_sessions, fetch=self.fetch_sessions,
+                                            render=self.render_session, key=lambda session: session.id)
+        self.tree = self.session_view.tree
         def create_handler(sort_by):
             def handler():
                 if self.sort_by == sort_by:
@@ -480,20 +494,17 @@ class MorseCodeXUI:
                 else:
                     self.sort_by = sort_by
                     self.sort_inverted = False
-                self.populate_tree(self.sort_by)
+                self.session_view.reload()
             return handler
         self.tree.heading('score', text='Score', command=create_handler('score'))
         self.tree.heading('date', text='Date', command=create_handler('date'))
         self.tree.heading('source', text='Source', command=create_handler('source_name'))
         self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        scrollbar = ttk.Scrollbar(self.session_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        self.tree.configure(yscroll=scrollbar.set)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.session_view.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
         self.tree.bind('<ButtonRelease-1>', self.on_click)
         self.tree.bind(gLeftButton, self.show_context_menu)
-        self.populate_tree(self.sort_by)
+        self.session_view.reload()
 
         self.create_details_frame()
 
@@ -519,7 +530,12 @@ class MorseCodeXUI:
         self.session_label = ttk.Label(self.detail_frame, text="")
         self.session_label.pack()
 
-        self.pair_tree = ttk.Treeview(self.detail_frame, columns=('received', 'sent', 'speed', 'duration'), show='headings')
+        # items are compared only when they come into view
+        self.pair_view = VirtualTreeview(self.detail_frame, columns=('received', 'sent', 'speed', 'duration'),
+                                         count=lambda: len(self.selected_session.items) if self.selected_session else 0,
+                                         fetch=self.fetch_pairs, render=lambda row: (row[1:5], row[5]),
+                                         key=lambda row: row[0])
+        self.pair_tree = self.pair_view.tree
         self.pair_tree.heading('received', text='Received')
         self.pair_tree.heading('sent', text='Sent')
         self.pair_tree.heading('speed', text='Speed')
@@ -528,9 +544,7 @@ class MorseCodeXUI:
         # self.pair_tree.column('speed', width=w)
         # self.pair_tree.column('duration', width=w)
         self.pair_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        scrollbar = ttk.Scrollbar(self.detail_frame, orient=tk.VERTICAL, command=self.pair_tree.yview)
-        self.pair_tree.configure(yscroll=scrollbar.set)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.pair_view.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
 
     def create_context_menu(self):
@@ -538,51 +552,52 @@ class MorseCodeXUI:
         self.context_menu.add_command(label="Delete", command=self.confirm_delete)
 
     def show_context_menu(self, event):
-        selected_item = self.tree.selection()
-        if selected_item:
+        if self.session_view.select_at(event.y):
             self.context_menu.post(event.x_root, event.y_root)
 
     def confirm_delete(self):
-        confirmed = messagebox.askyesno("Confirm Delete", "Are you sure you want to delete selected session(s)?")
+        session_ids = [session.id for session in self.session_view.selected_rows()]
+        if not session_ids:
+            return
+        confirmed = messagebox.askyesno("Confirm Delete",
+                                        f"Are you sure you want to delete {len(session_ids)} selected session(s)?")
         if not confirmed:
             return
-        selected_items = self.tree.selection()
-        for item in selected_items:
-            session_date = self.tree.item(item, 'values')[3]
-            self.session_db.delete_session(session_date)
-        self.populate_tree(self.sort_by)
-
-    def populate_tree(self, sort_by):
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        sessions = self.session_db.get_sorted_sessions(sort_by=sort_by, ascending=self.sort_inverted)
-        for session in sessions:
-            s = datetime.strptime(session.date, "%Y-%m-%dT%H:%M:%S.%f").strftime("%y-%m-%d\t%H-%M")
-            self.tree.insert('', tk.END, values=(session.score, s, session.source_name, session.date))
+        for session_id in session_ids:
+            self.session_db.delete_session_by_id(session_id)
+        self.session_view.remove(session_ids)
+
+    def fetch_sessions(self, offset, limit, previous):
+        # the page after the last cached session is found by key, jumps by offset
+        return self.session_db.get_session_headers(sort_by=self.sort_by, ascending=self.sort_inverted, after=previous,
+                                                   offset=0 if previous else offset, limit=limit)
+
+    def render_session(self, session):
+        s = datetime.strptime(session.date, "%Y-%m-%dT%H:%M:%S.%f").strftime("%y-%m-%d\t%H-%M")
+        return (session.score, s, session.source_name, session.id), ()
 
     def on_click(self, event):
         try:
             item = self.tree.focus()
-            session_date = self.tree.item(item, 'values')[3]
-            self.selected_session = self.session_db.get_session(session_date)
+            session_id = int(self.tree.item(item, 'values')[3])
+            self.selected_session = self.session_db.get_session_by_id(session_id)
             self.display_session()
         except IndexError:
             pass # ignore heading click
 
+    def fetch_pairs(self, offset, limit, previous):
+        rows = []
+        for i, (received, sent, speed, duration) in enumerate(self.selected_session.items[offset:offset + limit], offset):
+            correct, _ = self.compare_function(sent, received, self.shortcuts)
+            rows.append((i, received, sent, speed, float(duration), 'correct' if correct else 'incorrect'))
+        return rows
+
     def display_session(self):
         self.pair_tree.tag_configure('incorrect', foreground="red")
         self.pair_tree.tag_configure('correct', foreground="green")
         if self.selected_session:
             self.session_label.config(text=f"Session score: {self.selected_session.score}    Session Date: {self.selected_session.date}")
-            for item in self.pair_tree.get_children():
-                self.pair_tree.delete(item)
-            for received, sent, speed, duration in self.selected_session.items:
-                correct, _ = self.compare_function(sent, received, self.shortcuts)
-                if correct:
-                    t = 'correct'
-                else:
-                    t = 'incorrect'
-                self.pair_tree.insert('', tk.END, values=(received, sent, speed, float(duration)), tags=t)
+            self.pair_view.reload()
     
     def create_stat_screen(self):
         # Create a new window
@@ -653,8 +668,11 @@ class MorseCodeXUI:
         self.current_speed = (self.init_speed.get())
         self.morse_sources[0].set_speed(float(self.current_speed))
         t_morse = self.morse_sources[0].play_string("Vvv")
-        t_qrn = self.qrm_source.play_string("QRN QRN")
-        root.after(round(1000 * max(t_morse, t_qrn) + 0.5), self.on_sound_test_complete)
+        t_qrm = 0
+        if self.qrm_source.active:
+            self.qrm_source.reset(pause=0.5) # background stations come in right away
+            t_qrm = 3.0 # stations start after 0.5 s on average, enough to hear them, stop() cuts the messages short
+        root.after(round(1000 * max(t_morse, t_qrm) + 0.5), self.on_sound_test_complete)
 
     def on_sound_test_complete(self):
         self.player.stop()
@@ -764,13 +782,10 @@ class MorseCodeXUI:
 
         delays = np.random.random(self.signal_cnt.get()) * self.timing_spread.get()
         for msg, s, d in zip(self.msgs, self.morse_sources, delays):
-            threading.Timer(delay + d, s.play_string, args=[msg]).start()
+            self.player.schedule(s, msg, round((delay + d) * self.sample_rate)) # exact spread on the audio clock
 
     def stop_qrm(self):
-        if self.qrm_thread:
-            self.run_qrm_thread = False
-            self.qrm_thread.join()
-            self.qrm_thread = []
+        self.qrm_source.reset()
     
     def quit_app(self):
         self.stop_qrm()
@@ -1,33 +1,93 @@
 import numpy as np
 import queue
 import json
+import threading
+from collections import OrderedDict
 from helpers import log
 import helpers
 
+_morse_tables = {} # filename -> code table, shared by all sources
+
 def load_morse_table(filename):
+    if filename in _morse_tables:
+        return _morse_tables[filename]
     try:
         with open(filename, 'r') as file:
             morse_code_dict = json.load(file)
+        _morse_tables[filename] = morse_code_dict
         return morse_code_dict
     except FileNotFoundError:
         log("error", f"Morse code mapping file <{filename}> not found.")
-        exit() #FiXIT move exception handling up. This is not a correct place 
+        exit() #FiXIT move exception handling up. This is not a correct place
     except json.JSONDecodeError as e:
         log("error", f"Unable to decode {filename}: {e}")
         exit()
 
 
+class GlyphCache:
+    """ Process-wide LRU cache of unit amplitude glyph waveforms.
+        Keys are (wpm, frequency, rise_time, sample_rate, code), glyphs are rendered on first use
+        and the least recently used ones are evicted when the memory budget is exceeded """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._glyphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        with self._lock:
+            glyph = self._glyphs.get(key)
+            if glyph is not None:
+                self._glyphs.move_to_end(key)
+                self.hits += 1
+                return glyph
+            self.misses += 1
+        glyph = render() # outside of the lock, rendering may request other glyphs
+        with self._lock:
+            if key not in self._glyphs:
+                self._glyphs[key] = glyph
+                self.nbytes += glyph.nbytes
+                self._evict()
+        return glyph
+
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._glyphs.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._glyphs), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._glyphs) > 1:
+            _, glyph = self._glyphs.popitem(last=False)
+            self.nbytes -= glyph.nbytes
+            self.evictions += 1
+
+glyph_cache = GlyphCache()
+
+
 class MorseSoundSource:
     VolumeThreshold = helpers.dB2Amplitude(helpers.L_min) #determines if the source considered active or not
     def __init__(self, morse_mapping_filename, wpm=20, frequency=650, sample_rate=44100, rise_time=0.1, volume = 0.5, queue_sz = None):
         self.MORSE_CODE_DICT = load_morse_table(morse_mapping_filename)
         self._cur_msg = ''
-        self.signal_dict={}
         self.sample_rate = sample_rate  # Standard audio sample rate in Hz
         self.frequency = frequency
         self.rise_time = rise_time  # Default rise time
         self._volume = volume
-        self.signal = np.array([]) # last sent signal
+        self.playlist = () # last sent message as (template, samples) segments
+        self.playlist_length = 0
         if self.volume <= self.VolumeThreshold:
             self.active = False
         else:
@@ -41,8 +101,9 @@ class MorseSoundSource:
     def reset(self):
         while(not self.data_queue.empty()):
             self.data_queue.get()
-        self.signal = np.array([])
-    
+        self.playlist = ()
+        self.playlist_length = 0
+
     def set_speed(self, wpm, slowdown=0):
         # Calculate durations based on WPM
         if hasattr(self, 'wpm') and self.wpm == wpm:
@@ -53,10 +114,10 @@ class MorseSoundSource:
         self.element_gap = self.dit_duration
         self.symbol_gap = self.dah_duration + slowdown * self.dit_duration
         self.word_gap = 7 * self.dit_duration
-        
-        # Generate the arrays with the current frequency and volume
+
+        # Generate the arrays with the current frequency
         self._generate_arrays()
-    
+
     def set_frequency(self, frequency):
         self.frequency = frequency
         # Regenerate the arrays with the new frequency
@@ -70,13 +131,11 @@ class MorseSoundSource:
     def volume(self, in_volume):
         if hasattr(self, '_volume') and in_volume == self._volume:
             return
-        self._volume = in_volume
+        self._volume = in_volume # applied as the mixer gain, waveforms are unit amplitude
         if self._volume <= self.VolumeThreshold:
             self.deactivate()
             return
         self.activate()
-        # Regenerate the arrays with the new volume
-        self._generate_arrays()
 
     def set_rise(self, rise_time):
         self.rise_time = rise_time
@@ -87,39 +146,17 @@ class MorseSoundSource:
         return self.rise_time
 
     def _generate_arrays(self):
-        # Generate time vectors for each element
-        t_dit = np.linspace(0, self.dit_duration, int(self.dit_duration * self.sample_rate), endpoint=False)
-        t_dah = np.linspace(0, self.dah_duration, int(self.dah_duration * self.sample_rate), endpoint=False)
-        
-        # Generate the sine wave for each element
-        dit_wave = np.sin(2 * np.pi * self.frequency * t_dit)
-        dah_wave = np.sin(2 * np.pi * self.frequency * t_dah)
-        
-        # Apply rise time using a cosine function
-        rise_samples = int(self.rise_time * len(t_dit))  # Corrected rise samples calculation
+        # dit and dah are single element glyphs, shared through the glyph cache
+        self._glyph_key = (self.wpm, self.frequency, self.rise_time, self.sample_rate)
+        self.dit_array = self._glyph('.')
+        self.dah_array = self._glyph('-')
+
+        # Gaps are silence, only their lengths are needed
+        self.n_element_gap = int(self.element_gap * self.sample_rate)
+        self.n_symbol_gap = int(self.symbol_gap * self.sample_rate)
+        self.n_word_gap = int(self.word_gap * self.sample_rate)
+        self.playlist, self.playlist_length = self._convert_to_playlist(self._cur_msg)
 
-        if rise_samples > 0:
-            window_dit = np.ones(len(t_dit))
-            window_dah = np.ones(len(t_dah))
-            # Apply rise and fall for dit
-            window_dit[:rise_samples] = 0.5 * (1 - np.cos(np.pi * np.arange(rise_samples) / rise_samples))
-            window_dit[-rise_samples:] = 0.5 * (1 - np.cos(np.pi * np.arange(rise_samples, 0, -1) / rise_samples))
-            dit_wave *= window_dit
-            # Apply rise and fall for dah
-            window_dah[:rise_samples] = 0.5 * (1 - np.cos(np.pi * np.arange(rise_samples) / rise_samples))
-            window_dah[-rise_samples:] = 0.5 * (1 - np.cos(np.pi * np.arange(rise_samples, 0, -1) / rise_samples))
-            dah_wave *= window_dah
-
-        self.dit_array = self._volume * dit_wave
-        self.dah_array = self._volume * dah_wave
-        
-        # Generate silence arrays for gaps
-        self.element_gap_array = np.zeros(int(self.element_gap * self.sample_rate))
-        self.symbol_gap_array = np.zeros(int(self.symbol_gap * self.sample_rate))
-        self.word_gap_array = np.zeros(int(self.word_gap * self.sample_rate))
-        self._build_signal_dict()
-        self.signal = self._convert_to_signal(self._cur_msg)
-    
     def get_speed(self):
         return self.wpm
 
@@ -139,61 +176,120 @@ class MorseSoundSource:
         return {
             "dit_array": self.dit_array,
             "dah_array": self.dah_array,
-            "element_gap_array": self.element_gap_array,
-            "symbol_gap_array": self.symbol_gap_array,
-            "word_gap_array": self.word_gap_array
+            "element_gap_array": np.zeros(self.n_element_gap, dtype=np.float32),
+            "symbol_gap_array": np.zeros(self.n_symbol_gap, dtype=np.float32),
+            "word_gap_array": np.zeros(self.n_word_gap, dtype=np.float32)
         }
 
-    def play_string(self, message = None):
-        """ will repeat previously sent message if no new message provided """
+    def play_string(self, message = None, delay_samples=0, block=True):
+        """ will repeat previously sent message if no new message provided.
+            delay_samples of silence are queued ahead of the message, with block=False a full queue drops the message """
         if not self.active:
             if message:
                 self._cur_msg = message.upper()
             return 0
         if message:
             self._cur_msg = message.upper()
-            self.signal = self._convert_to_signal(self._cur_msg)
-        if self.signal.any():
-            self.data_queue.put(self.signal)
-            return float(len(self.signal))/self.sample_rate
+            self.playlist, self.playlist_length = self._convert_to_playlist(self._cur_msg)
+        if self.playlist_length:
+            playlist = ((None, delay_samples),) + self.playlist if delay_samples > 0 else self.playlist
+            try:
+                self.data_queue.put([playlist, 0, 0], block=block) # playlist, current segment, offset in the segment
+            except queue.Full:
+                return 0
+            return float(self.playlist_length + max(0, delay_samples))/self.sample_rate
         else:
             return 0
-    
+
+    def prepare(self, message):
+        """ message converted ahead of time for play_prepared(), the thread that plays it does not parse it """
+        message = message.upper()
+        return [message, *self._convert_to_playlist(message), self._glyph_key]
+
+    def play_prepared(self, prepared, delay_samples=0, block=True):
+        """ play_string for a prepare() result. It is converted again, once, if speed, pitch or rise time
+            changed since, prepared keeps the new playlist for repeats """
+        message, playlist, length, glyph_key = prepared
+        if glyph_key != self._glyph_key:
+            playlist, length = self._convert_to_playlist(message)
+            prepared[1:] = playlist, length, self._glyph_key
+        self._cur_msg = message
+        self.playlist, self.playlist_length = playlist, length
+        return self.play_string(None, delay_samples, block)
+
     def get_audio_segment(self, size):
-        result = np.zeros(size, dtype=np.float32)
+        result = np.empty(size, dtype=np.float32)
+        self.render_into(result, size)
+        return result
+
+    def render_into(self, out, frames):
+        """ write the next frames samples into out[:frames], silence once the queue runs dry.
+            Returns the number of frames taken from the queue, 0 for an idle source """
         filled = 0
 
-        while filled < size and not self.data_queue.empty():
-            data = self.data_queue.queue[0]  # Peek at the first array in the queue
-            available = len(data)
-            to_copy = min(size - filled, available)
-            result[filled:filled + to_copy] = data[:to_copy]
+        while filled < frames and not self.data_queue.empty():
+            entry = self.data_queue.queue[0]  # Peek at the first playlist in the queue
+            playlist, index, offset = entry
+            template, length = playlist[index]
+            to_copy = min(frames - filled, length - offset)
+            if template is None: # gap
+                out[filled:filled + to_copy] = 0
+            else:
+                out[filled:filled + to_copy] = template[offset:offset + to_copy]
             filled += to_copy
+            offset += to_copy
 
-            if to_copy < available:
-                self.data_queue.queue[0] = data[to_copy:]  # Update the front array
-            else:
-                self.data_queue.get()  # Remove the front array from the queue
+            if offset == length:
+                index += 1
+                offset = 0
+                if index == len(playlist):
+                    self.data_queue.get()  # Remove the finished playlist from the queue
+                    continue
+            entry[1], entry[2] = index, offset  # Update the front playlist position
 
-        return result
+        if filled < frames:
+            out[filled:frames] = 0
+        return filled
 
-    def _generate_signal(self, morse_code_list):
-        signal = np.array([])
-        for symbol in morse_code_list:
-            if symbol == ' ':
-                signal = np.concatenate([signal, self.word_gap_array])
-            else:
-                for i, element in enumerate(symbol):
-                    if element == '.':
-                        signal = np.concatenate([signal, self.dit_array])
-                    elif element == '-':
-                        signal = np.concatenate([signal, self.dah_array])
-                    if i < len(symbol) - 1:  # Add element gap if not the last element
-                        signal = np.concatenate([signal, self.element_gap_array])
-                signal = np.concatenate([signal, self.symbol_gap_array])
-        if len(signal) == 0:
-            return np.array([])  # Return an empty array if no valid Morse code is generated
-        return signal  # Ensure signal is a list of arrays
+    def _render_element(self, duration):
+        # Generate time vector and the sine wave for the element
+        t = np.linspace(0, duration, int(duration * self.sample_rate), endpoint=False)
+        wave = np.sin(2 * np.pi * self.frequency * t)
+
+        # Apply rise time using a cosine function, rise is relative to the dit length for all elements
+        rise_samples = int(self.rise_time * int(self.dit_duration * self.sample_rate))
+        if rise_samples > 0:
+            window = np.ones(len(t))
+            window[:rise_samples] = 0.5 * (1 - np.cos(np.pi * np.arange(rise_samples) / rise_samples))
+            window[-rise_samples:] = 0.5 * (1 - np.cos(np.pi * np.arange(rise_samples, 0, -1) / rise_samples))
+            wave *= window
+        return wave.astype(np.float32)
+
+    def _render_glyph(self, code):
+        # single element glyphs are the templates everything else is built from
+        if code == '.':
+            return self._render_element(self.dit_duration)
+        if code == '-':
+            return self._render_element(self.dah_duration)
+        # sizes are known upfront from the code: allocate once and fill in a single pass
+        n_dit, n_dah = len(self.dit_array), len(self.dah_array)
+        total = code.count('.') * n_dit + code.count('-') * n_dah + max(0, len(code) - 1) * self.n_element_gap
+        glyph = np.zeros(total, dtype=np.float32)
+        pos = 0
+        for i, element in enumerate(code):
+            if element == '.':
+                glyph[pos:pos + n_dit] = self.dit_array
+                pos += n_dit
+            elif element == '-':
+                glyph[pos:pos + n_dah] = self.dah_array
+                pos += n_dah
+            if i < len(code) - 1:  # Add element gap if not the last element
+                pos += self.n_element_gap
+        return glyph
+
+    def _glyph(self, code):
+        """ unit amplitude waveform of the code without trailing symbol gap """
+        return glyph_cache.get(self._glyph_key + (code,), lambda: self._render_glyph(code))
 
     def deactivate(self):
         self.active = False
@@ -202,13 +298,9 @@ class MorseSoundSource:
     def activate(self):
         self.active = True
 
-#Optimization
-    def _build_signal_dict(self):
-        for char, code in self.MORSE_CODE_DICT.items():
-            self.signal_dict[char] = self._generate_signal([code])
-
-    def _convert_to_signal(self, message):
-        signal = np.array([])
+    def _message_symbols(self, message):
+        """ list of MORSE_CODE_DICT keys for the message, ' ' stands for the word gap """
+        symbols = []
         i = 0
         while i < len(message):
             if message[i] == '<':  # Detect start of a prosign
@@ -216,12 +308,115 @@ class MorseSoundSource:
                 if end != -1:
                     prosign = message[i+1:end]
                     if prosign in self.MORSE_CODE_DICT:
-                        signal = np.concatenate([signal, self.signal_dict[prosign]])
+                        symbols.append(prosign)
                     i = end
             elif message[i] == ' ':
-                signal = np.concatenate([signal, self.word_gap_array])
+                symbols.append(' ')
             else:
-                char = message[i]
-                signal = np.concatenate([signal, self.signal_dict[char]])
+                symbols.append(message[i])
             i += 1
+        return symbols
+
+    def _convert_to_playlist(self, message):
+        """ message as a tuple of (template, samples) segments referencing the shared dit/dah arrays,
+            template None is a gap. Returns the playlist and its length in samples """
+        n_dit, n_dah = len(self.dit_array), len(self.dah_array)
+        playlist = []
+        gap = 0 # pending silence, adjacent gaps are merged into one segment
+        for symbol in self._message_symbols(message):
+            if symbol == ' ':
+                gap += self.n_word_gap
+                continue
+            code = self.MORSE_CODE_DICT[symbol]
+            for i, element in enumerate(code):
+                if element in '.-':
+                    if gap:
+                        playlist.append((None, gap))
+                        gap = 0
+                    if element == '.':
+                        playlist.append((self.dit_array, n_dit))
+                    else:
+                        playlist.append((self.dah_array, n_dah))
+                if i < len(code) - 1:
+                    gap += self.n_element_gap
+            gap += self.n_symbol_gap
+        if not playlist: # nothing to key
+            return (), 0
+        if gap:
+            playlist.append((None, gap))
+        return tuple(playlist), sum(length for _, length in playlist)
+
+    def _message_marks(self, message):
+        """ (symbol, start, end) sample offsets of every symbol of the message and the total length in samples,
+            the end of a glyph excludes the gap that follows it """
+        marks = []
+        pos = 0
+        for symbol in self._message_symbols(message):
+            if symbol == ' ':
+                marks.append((symbol, pos, pos + self.n_word_gap))
+                pos += self.n_word_gap
+            else:
+                length = len(self._glyph(self.MORSE_CODE_DICT[symbol]))
+                marks.append((symbol, pos, pos + length))
+                pos += length + self.n_symbol_gap
+        return marks, pos
+
+    def _convert_to_signal(self, message):
+        # layout first, then a single pass over a preallocated buffer
+        marks, total = self._message_marks(message)
+        signal = np.zeros(total, dtype=np.float32)
+        for symbol, start, end in marks:
+            if symbol != ' ': # word gap silence is already there
+                signal[start:end] = self._glyph(self.MORSE_CODE_DICT[symbol])
         return signal  # Return array of samples
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: single pass rendering vs. the former per character concatenation
+    import sys
+    import timeit
+    from DataSource import DataSource
+
+    def concat_convert_to_signal(source, message):
+        symbol_gap_array = np.zeros(source.n_symbol_gap, dtype=np.float32)
+        word_gap_array = np.zeros(source.n_word_gap, dtype=np.float32)
+        signal = np.array([], dtype=np.float32)
+        for symbol in source._message_symbols(message):
+            if symbol == ' ':
+                signal = np.concatenate([signal, word_gap_array])
+            else:
+                signal = np.concatenate([signal, source._glyph(source.MORSE_CODE_DICT[symbol]), symbol_gap_array])
+        return signal
+
+    for wpm in (20, 60, 90):
+        source = MorseSoundSource('configs/morse_table.json', wpm=wpm)
+        for file_name in ('MASTER.SCP', 'NAQPCW.txt'):
+            data_source = DataSource(file_path=f'data_sources/{file_name}', policies_file='configs/message_policies.json',
+                                     num_words=200, pre_message=True, rst=True, serial=True)
+            messages = []
+            while True:
+                pre_msg, rst, ser_num, msg = data_source.get_next_word()
+                if msg is None:
+                    break
+                messages.append((pre_msg + rst + ser_num + msg).upper())
+            for message in messages:
+                assert np.array_equal(source._convert_to_signal(message), concat_convert_to_signal(source, message)), message
+                # playlist playback must produce the same samples
+                source.play_string(message)
+                played = source.get_audio_segment(source.playlist_length + 1000)
+                assert np.array_equal(played[:source.playlist_length], source._convert_to_signal(message)), message
+                assert source.data_queue.empty()
+            t_concat = min(timeit.repeat(lambda: [concat_convert_to_signal(source, m) for m in messages], number=3, repeat=3))
+            t_single = min(timeit.repeat(lambda: [source._convert_to_signal(m) for m in messages], number=3, repeat=3))
+            n = 3 * len(messages)
+            print(f"{file_name:<12} {wpm:>3} WPM: concatenate {1e6 * t_concat / n:8.1f} us/msg, "
+                  f"single pass {1e6 * t_single / n:8.1f} us/msg, speedup {t_concat / t_single:5.2f}x")
+            playlist_bytes = sum(sys.getsizeof(source._convert_to_playlist(m)[0]) for m in messages) / len(messages)
+            signal_bytes = sum(source._convert_to_signal(m).nbytes for m in messages) / len(messages)
+            print(f"{'':<12} {wpm:>3} WPM: queued message {signal_bytes / 1024:8.1f} KiB as array, "
+                  f"{playlist_bytes / 1024:8.1f} KiB as playlist")
+
+    # Glyph cache: pileup sources share glyphs, speed changes are lookups after the first render
+    sources = [MorseSoundSource('configs/morse_table.json', wpm=30, frequency=600) for _ in range(20)]
+    t_speed = min(timeit.repeat(lambda: [s.set_speed(wpm) for wpm in range(20, 41) for s in sources], number=1, repeat=3))
+    print(f"set_speed on 20 sources: {1e6 * t_speed / (21 * 20):6.1f} us/call, cache {glyph_cache.stats()}")
@@ -1,14 +1,60 @@
 import numpy as np
 import helpers
 
+_FFT_OUT = np.lib.NumpyVersion(np.__version__) >= '2.0.0' # numpy 2 ffts can write into preallocated arrays
+
+class BandNoiseGenerator:
+    """ Endless band limited white noise produced block by block with an overlap-save FIR filter,
+        memory stays constant and the noise never repeats. Same band and level as helpers.band_pass_filter """
+    def __init__(self, bandpass=(300, 900), sample_rate=44100, taps=None, fft_size=16384, seed=None):
+        if taps is None:
+            taps = int(sample_rate / 40) | 1 # odd length, ~250 Hz transition band with the blackman window
+        n = np.arange(taps) - (taps - 1) / 2
+        low, high = bandpass[0] / sample_rate, bandpass[1] / sample_rate
+        kernel = 2 * high * np.sinc(2 * high * n) - 2 * low * np.sinc(2 * low * n)
+        kernel *= np.blackman(taps) * 0.5 # band_pass_filter keeps positive frequencies only, half the amplitude
+        self.fft_size = 1 << (max(fft_size, 2 * taps) - 1).bit_length()
+        self.history = taps - 1
+        self.step = self.fft_size - self.history # new samples per filtered chunk
+        self.response = np.fft.rfft(kernel, self.fft_size)
+        self.rng = np.random.default_rng(seed)
+        self.input = np.empty(self.fft_size)
+        self.input[:self.history] = self.rng.standard_normal(self.history) # primed, no fade in at the start
+        self.spectrum = np.empty(self.fft_size // 2 + 1, dtype=np.complex128)
+        self.filtered = np.empty(self.fft_size)
+        self.available = 0 # unread samples at the end of self.filtered
+
+    def _next_chunk(self):
+        self.rng.standard_normal(out=self.input[self.history:])
+        if _FFT_OUT:
+            np.fft.rfft(self.input, out=self.spectrum)
+            self.spectrum *= self.response
+            np.fft.irfft(self.spectrum, self.fft_size, out=self.filtered)
+        else:
+            self.filtered[:] = np.fft.irfft(np.fft.rfft(self.input) * self.response, self.fft_size)
+        self.input[:self.history] = self.input[self.step:] # filter state for the next chunk
+        self.available = self.step
+
+    def render_into(self, out, frames):
+        filled = 0
+        while filled < frames:
+            if not self.available:
+                self._next_chunk()
+            to_copy = min(frames - filled, self.available)
+            start = self.fft_size - self.available
+            out[filled:filled + to_copy] = self.filtered[start:start + to_copy]
+            filled += to_copy
+            self.available -= to_copy
+
 class NoiseSoundSource:
     VolumeThreshold = helpers.dB2Amplitude(helpers.L_min) #determines if the source considered active or not
     def __init__(self, generator=None, audio_segment = None, duration = 1.0, initial_volume=1.0, sample_rate=44100):
         """
         :param generator: Function that generates numpy array of audio samples (will override audio_samples)
-        :param audio_segment: numpy array with audio samles (no need for generator) 
+                          or a streaming generator with render_into(out, frames) like BandNoiseGenerator
+        :param audio_segment: numpy array with audio samles or helpers.WavReader converted block by block (no need for generator)
         :param duration: Duration of the pre-generated audio segment
-        :param initial_volume: Initial volume as a float multiplier (1.0 = original volume)
+        :param initial_volume: Initial volume as a float multiplier (1.0 = original volume), applied by the mixer
         :param sample_rate: Sample rate for the audio
         """
         self.generator = generator
@@ -19,12 +65,18 @@ class NoiseSoundSource:
             self.active = False
         else:
             self.active = True
-        self.source_audio_segment__ = audio_segment
+        self.source_audio_segment = audio_segment
         self.current_position = 0
+        self.streaming = hasattr(self.generator, 'render_into')
+        if self.streaming: # nothing pre-generated, every block is new noise
+            self.source_audio_segment = None
+            self.source_segment_length = 0
+            return
         if self.generator is not None:
-            self.source_audio_segment__ = self.generator(self.duration, self.sample_rate)
-        self.source_audio_segment = self.source_audio_segment__ * self._volume
-        self.source_segment_length = len(self.source_audio_segment__)
+            self.source_audio_segment = self.generator(self.duration, self.sample_rate)
+        if not isinstance(self.source_audio_segment, helpers.WavReader):
+            self.source_audio_segment = np.asarray(self.source_audio_segment, dtype=np.float32) # mixer works in float32
+        self.source_segment_length = len(self.source_audio_segment)
 
     @property
     def volume(self):
@@ -39,28 +91,41 @@ class NoiseSoundSource:
             self.deactivate()
             return
         self.activate()
-        self.source_audio_segment = self.source_audio_segment__ * self._volume
 
     def get_audio_segment(self, segment_length):
+        segment = np.empty(segment_length, dtype=np.float32)
+        self.render_into(segment, segment_length)
+        return segment
+
+    def render_into(self, out, frames):
+        """ write the next frames samples into out[:frames], wrapping around the source segment.
+            Returns the number of audible frames, 0 when inactive """
         if not self.active:
-            return np.zeros(segment_length)
-                
+            out[:frames] = 0
+            return 0
+        if self.streaming:
+            self.generator.render_into(out, frames)
+            return frames
+
         start_position = self.current_position
-        end_position = (self.current_position + segment_length) % self.source_segment_length
+        filled = min(frames, self.source_segment_length - start_position)
+        self._read_into(out, start_position, filled)
+        while filled < frames: # wrapped, the segment may be shorter than the block
+            to_copy = min(frames - filled, self.source_segment_length)
+            self._read_into(out[filled:], 0, to_copy)
+            filled += to_copy
 
-        if start_position + segment_length <= self.source_segment_length:
-            segment = self.source_audio_segment[start_position:start_position + segment_length]
-        else:
-            segment = np.concatenate((
-                self.source_audio_segment[start_position:],
-                self.source_audio_segment[:end_position]
-            ))
+        self.current_position = (start_position + frames) % self.source_segment_length
+        return frames
 
-        self.current_position = end_position
-        return segment
+    def _read_into(self, out, start, frames):
+        if isinstance(self.source_audio_segment, helpers.WavReader): # converted only when played
+            self.source_audio_segment.read_into(out, start, frames)
+        else:
+            out[:frames] = self.source_audio_segment[start:start + frames]
 
     def deactivate(self):
         self.active = False
 
     def activate(self):
-        self.active = True
\ No newline at end of file
+        self.active = True
@@ -3,7 +3,8 @@ from helpers import log
 from collections import Counter
 
 class Session:
-    def __init__(self, date, source_name, volume=0.0, noise=0.0, qrn=0.0, qrm=0.0, mode=0, items=None, score=0):
+    def __init__(self, date, source_name, volume=0.0, noise=0.0, qrn=0.0, qrm=0.0, mode=0, items=None, score=0, id=None):
+        self.id = id # row id once stored
         self.date = date
         self.source_name = source_name
         self.volume = volume
@@ -34,6 +35,8 @@ import sqlite3
 from helpers import log
 
 class SessionDB:
+    SORT_COLUMNS = ('score', 'date', 'source_name')
+
     def __init__(self, db_name='sessions.db'):
         self.conn = sqlite3.connect(db_name)
         self.conn.execute("PRAGMA foreign_keys = ON")  # Ensure foreign keys are enforced
@@ -88,6 +91,20 @@ class SessionDB:
 
             # Index to make session lookups by source name faster
             self.conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_source_name ON sessions(source_name)')
+            # Indexes for the sorted listing (the rowid is part of every index), lookups by date and the items of a session
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_score ON sessions(score)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_date ON sessions(date)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_items_session_id ON items(session_id)')
+
+            # error count of every missed message per source, the primary key serves the lookups by source
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS challenges (
+                    source_name TEXT,
+                    msg TEXT,
+                    errors INTEGER,
+                    PRIMARY KEY (source_name, msg)
+                ) WITHOUT ROWID
+            ''')
 
     def add_session(self, session):
         with self.conn:
@@ -102,6 +119,7 @@ class SessionDB:
                   session.noise, session.qrn, session.qrm, session.mode))
 
             session_id = self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            session.id = session_id
 
             # Batch insert items associated with this session
             items_data = [(session_id, received, sent, speed, duration) for received, sent, speed, duration in session.items]
@@ -120,13 +138,52 @@ class SessionDB:
             self.conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
 
     def get_sorted_sessions(self, sort_by='score', ascending=False):
+        """ every session with its items, see get_session_headers for listings """
+        sessions = self.get_session_headers(sort_by=sort_by, ascending=ascending, limit=None)
+        items = {session.id: [] for session in sessions}
+        with self.conn:
+            for session_id, received, sent, speed, duration in self.conn.execute('''
+                SELECT session_id, received, sent, speed, duration FROM items ORDER BY id
+            '''):
+                items[session_id].append((received, sent, speed, duration))
+        for session in sessions:
+            session.items = items[session.id]
+        return sessions
+
+    def get_session_headers(self, sort_by='score', ascending=False, after=None, offset=0, limit=100):
+        """ sessions without items (see get_items) sorted by sort_by then id, limit at a time.
+            after is the last session of the previous page: pages are found through the index, whatever their depth.
+            offset skips rows (after the after session if given), for jumps to an arbitrary position """
+        if sort_by not in self.SORT_COLUMNS:
+            raise ValueError(f"Unable to sort sessions by {sort_by}")
         order = 'ASC' if ascending else 'DESC'
+        query = 'SELECT id, date, score, source_name, volume, noise, qrn, qrm, mode FROM sessions'
+        params = []
+        if after is not None:
+            query += f' WHERE ({sort_by}, id) {">" if ascending else "<"} (?, ?)'
+            params += [getattr(after, sort_by), after.id]
+        query += f' ORDER BY {sort_by} {order}, id {order}'
+        if limit is not None or offset:
+            query += ' LIMIT ? OFFSET ?'
+            params += [-1 if limit is None else limit, offset]
         with self.conn:
-            cursor = self.conn.execute(f'''
-                SELECT id, date, score, source_name, volume, noise, qrn, qrm, mode FROM sessions ORDER BY {sort_by} {order}
-            ''')
-            sessions = cursor.fetchall()
-        return [self.get_session_by_id(session[0]) for session in sessions]
+            rows = self.conn.execute(query, params).fetchall()
+        return [Session(id=session_id, date=date, score=score, source_name=source_name, volume=volume, noise=noise,
+                        qrn=qrn, qrm=qrm, mode=mode)
+                for session_id, date, score, source_name, volume, noise, qrn, qrm, mode in rows]
+
+    def count_sessions(self):
+        with self.conn:
+            return self.conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def get_items(self, session_id):
+        with self.conn:
+            return self.conn.execute('''
+                SELECT received, sent, speed, duration
+                FROM items
+                WHERE session_id = ?
+                ORDER BY id
+            ''', (session_id,)).fetchall()
 
     def get_session_id(self, date : str) -> int:
         with self.conn:
@@ -137,7 +194,7 @@ class SessionDB:
                 WHERE date = ?
             ''', (date,)).fetchone()
 
-            return session_id[0]
+            return session_id[0] if session_id else None
 
     def get_session(self, date):
         session_id = self.get_session_id(date)
@@ -160,16 +217,9 @@ class SessionDB:
 
             session_id, date, score, source_name, volume, noise, qrn, qrm, mode = session_data
 
-            # Fetch the related items for the session
-            items = self.conn.execute('''
-                SELECT received, sent, speed, duration
-                FROM items
-                WHERE session_id = ?
-            ''', (session_id,)).fetchall()
-
-            # Create and return the session object, passing the items list directly
+            # Create and return the session object with its items
             session = Session(date=date, source_name=source_name, volume=volume, noise=noise,
-                            qrn=qrn, qrm=qrm, mode=mode, score=score, items=items)
+                            qrn=qrn, qrm=qrm, mode=mode, score=score, items=self.get_items(session_id), id=session_id)
 
             return session
     
@@ -182,6 +232,36 @@ class SessionDB:
             sources = cursor.fetchall()
         return [source[0] for source in sources] #untuple
 
+    def get_challenges(self, source_name):
+        """ {message: error count} of a source """
+        with self.conn:
+            rows = self.conn.execute('''
+                SELECT msg, errors FROM challenges WHERE source_name = ?
+            ''', (source_name,)).fetchall()
+        return dict(rows)
+
+    def import_challenges(self, source_name, challenges):
+        """ adds {message: error count} to the stored counts in one transaction, negative counts are skipped """
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO challenges (source_name, msg, errors) VALUES (?, ?, ?)
+                ON CONFLICT (source_name, msg) DO UPDATE SET errors = errors + excluded.errors
+            ''', [(source_name, msg, errors) for msg, errors in challenges.items() if errors >= 0])
+
+    def update_challenge(self, source_name, msg, delta):
+        """ adds delta to the error count of a message and returns the new count, a count below 0 removes the message """
+        with self.conn:
+            self.conn.execute('''
+                INSERT INTO challenges (source_name, msg, errors) VALUES (?, ?, ?)
+                ON CONFLICT (source_name, msg) DO UPDATE SET errors = errors + excluded.errors
+            ''', (source_name, msg, delta))
+            errors = self.conn.execute('''
+                SELECT errors FROM challenges WHERE source_name = ? AND msg = ?
+            ''', (source_name, msg)).fetchone()[0]
+            if errors < 0:
+                self.conn.execute('DELETE FROM challenges WHERE source_name = ? AND msg = ?', (source_name, msg))
+        return errors
+
     def set_version(self, version_tuple):
         if len(version_tuple) != 4:
             raise ValueError("Version must be a tuple with 4 numeric values (major, minor, patch, prerelease)")
@@ -432,7 +512,47 @@ if __name__ == "__main__":
     session_db.set_version((1, 2, 3, 4))
     version = session_db.get_version()
     assert version == (1, 2, 3, 4)
+
+    # Challenges: counts add up, a message answered right more often than missed is gone
+    session_db.import_challenges('Source1', {'K1ABC': 2, 'W2XYZ': 0, 'N3OLD': -1})
+    assert session_db.update_challenge('Source1', 'K1ABC', 1) == 3
+    assert session_db.update_challenge('Source1', 'W2XYZ', -1) == -1
+    assert session_db.update_challenge('Source2', 'K1ABC', 1) == 1
+    assert session_db.get_challenges('Source1') == {'K1ABC': 3}
+    print("Challenges of Source1:", session_db.get_challenges('Source1'))
     #convert_v0950('sessions.db')
     s = SessionDB('sessions.db')
     s.get_histogram('ca_counties.txt')
-    
\ No newline at end of file
+    
+    # Listing with years of history: every session with its items against one page of headers
+    import tempfile
+    import time
+    big_db = SessionDB(os.path.join(tempfile.mkdtemp(), 'big.db'))
+    for i in range(20000):
+        big_db.conn.execute('INSERT OR IGNORE INTO source_names (name) VALUES (?)', (f"Source{i % 7}",))
+        big_db.conn.execute('INSERT INTO sessions (date, score, source_name, volume, noise, qrn, qrm, mode) '
+                            'VALUES (?, ?, ?, 0.5, 0.3, 0.0, 0.0, 0)',
+                            (f"2020-01-01T00:00:{i:06d}.000", (i * 7919) % 5000, f"Source{i % 7}"))
+        big_db.conn.executemany('INSERT INTO items (session_id, received, sent, speed, duration) VALUES (?, ?, ?, ?, ?)',
+                                [(i + 1, 'K1ABC', 'K1ABC', 30, 1.3)] * 30)
+    big_db.conn.commit()
+    start = time.perf_counter()
+    everything = big_db.get_sorted_sessions(sort_by='score')
+    t_all = time.perf_counter() - start
+    for sort_by in SessionDB.SORT_COLUMNS:
+        start = time.perf_counter()
+        page = big_db.get_session_headers(sort_by=sort_by, limit=100)
+        t_page = time.perf_counter() - start
+        listed = []
+        while page:
+            listed += page
+            page = big_db.get_session_headers(sort_by=sort_by, after=page[-1], limit=100)
+        assert [s.id for s in listed] == [s.id for s in big_db.get_session_headers(sort_by=sort_by, limit=None)]
+        start = time.perf_counter()
+        page = big_db.get_session_headers(sort_by=sort_by, after=listed[15000], limit=100)
+        t_deep = time.perf_counter() - start
+        print(f"sorted by {sort_by:<11}: first page {t_page * 1e3:.2f} ms, page at 15000 {t_deep * 1e3:.2f} ms")
+    start = time.perf_counter()
+    session = big_db.get_session_by_id(big_db.get_session_id(everything[-1].date))
+    t_click = time.perf_counter() - start
+    print(f"{len(everything)} sessions with their items {t_all * 1e3:.0f} ms, one session by date {t_click * 1e3:.2f} ms")
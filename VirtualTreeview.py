@@ -0,0 +1,196 @@
+import tkinter as tk
+from tkinter import ttk
+
+class VirtualTreeview:
+    """ ttk.Treeview over a long list: only the rows in view exist as tree items and they are updated in place
+        while scrolling. Rows come from fetch a page at a time with a margin cached around the view,
+        the scrollbar stands for the whole list. The selection is kept by row key across scrolling """
+    def __init__(self, parent, columns, count, fetch, render, key=None, margin=50, **tree_options):
+        """
+        :param count: function returning the number of rows
+        :param fetch: function(offset, limit, previous) returning up to limit rows from offset, previous is the row
+                      before offset when known so the page can be found by key instead of by offset
+        :param render: function(row) returning (values, tags) of a tree item
+        :param key: function(row) identifying a row in the selection, the row itself by default
+        :param margin: rows cached above and below the view
+        """
+        self.tree = ttk.Treeview(parent, columns=columns, show='headings', **tree_options)
+        self.scrollbar = ttk.Scrollbar(parent, orient=tk.VERTICAL, command=self.yview)
+        self.count = count
+        self.fetch = fetch
+        self.render = render
+        self.key = key or (lambda row: row)
+        self.margin = margin
+        self.total = 0
+        self.first = 0 # list index of the top row
+        self.start = 0 # list index of rows[0]
+        self.rows = [] # cache around the view
+        self.shown = [] # rows of the tree items row0, row1...
+        self.visible = 10
+        self.header_height = None
+        self.row_height = None
+        self.selected = {} # key -> row
+        # Shift and Control (Command on macOS) extend the selection, other clicks and keys replace it
+        aqua = self.tree.tk.call('tk', 'windowingsystem') == 'aqua'
+        self.extend_mask = 0x0001 | 0x0004 | (0x0008 if aqua else 0)
+        self.replace = False # the next selection event comes from a plain click or key
+        self.tree.bind('<Configure>', self._on_resize)
+        self.tree.bind('<<TreeviewSelect>>', self._on_select)
+        self.tree.bind('<ButtonPress-1>', self._on_input)
+        self.tree.bind('<KeyPress>', self._on_input)
+        self.tree.bind('<MouseWheel>', self._on_wheel)
+        self.tree.bind('<Button-4>', self._on_wheel)
+        self.tree.bind('<Button-5>', self._on_wheel)
+        self.tree.bind('<Up>', lambda event: self._on_arrow(event, -1))
+        self.tree.bind('<Down>', lambda event: self._on_arrow(event, 1))
+        self.tree.bind('<Prior>', lambda event: self._scroll(-self.visible))
+        self.tree.bind('<Next>', lambda event: self._scroll(self.visible))
+
+    def reload(self):
+        """ list changed completely (new content or order), back to the top """
+        self.total = self.count()
+        self.first = 0
+        self.start = 0
+        self.rows = []
+        self.selected = {}
+        self._show()
+
+    def remove(self, keys):
+        """ rows of keys were deleted from the list, the view keeps its place """
+        keys = set(keys)
+        for key in keys:
+            self.selected.pop(key, None)
+        self.total = self.count()
+        rows = [row for row in self.rows if self.key(row) not in keys]
+        if len(self.rows) - len(rows) == len(keys):
+            self.rows = rows
+        else: # some were outside the cache, the positions are unknown
+            self.rows = []
+        self._show()
+
+    def selected_rows(self):
+        return list(self.selected.values())
+
+    def select_at(self, y):
+        """ context menu click: the row at y becomes the selection unless it is selected already.
+            Returns False when there is neither a row at y nor a selected row in view """
+        item = self.tree.identify_row(y)
+        if not item:
+            return bool(self.tree.selection())
+        if item not in self.tree.selection():
+            row = self.shown[int(item[3:])]
+            self.selected = {self.key(row): row}
+            self.replace = False
+            self.tree.selection_set(item)
+        self.tree.focus(item)
+        return True
+
+    def yview(self, *args):
+        """ scrollbar command """
+        if args[0] == 'moveto':
+            self.first = int(float(args[1]) * self.total)
+            self._show()
+        elif args[0] == 'scroll':
+            self._scroll(int(args[1]) * (self.visible if args[2] == 'pages' else 1))
+
+    def _scroll(self, rows):
+        self.first += rows
+        self._show()
+        return 'break'
+
+    def _on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            return self._scroll(-3)
+        return self._scroll(3)
+
+    def _on_arrow(self, event, step):
+        # at the first or last item of the view the list moves instead of the focus
+        self._on_input(event)
+        focus = self.tree.focus()
+        edge = 'row0' if step < 0 else f'row{len(self.shown) - 1}'
+        if focus != edge or not 0 <= self.first + step <= self.total - len(self.shown):
+            return None
+        self.first += step
+        self.selected = {}
+        self._show()
+        row = self.shown[int(edge[3:])]
+        self.selected[self.key(row)] = row
+        self.tree.selection_set(edge)
+        self.tree.focus(edge)
+        return 'break'
+
+    def _on_resize(self, event):
+        self._fit(event.height)
+
+    def _measure(self):
+        bbox = self.tree.bbox('row0') if self.shown else ''
+        if bbox and self.row_height is None:
+            self.header_height, self.row_height = bbox[1], bbox[3]
+            self._fit(self.tree.winfo_height())
+
+    def _fit(self, height):
+        # rows that fit the tree, the style row height is known once an item is drawn
+        visible = max(1, (height - (self.header_height or 25)) // (self.row_height or 20))
+        if visible != self.visible:
+            self.visible = visible
+            self._show()
+
+    def _on_input(self, event):
+        self.replace = not event.state & self.extend_mask
+
+    def _on_select(self, event):
+        selection = set(self.tree.selection())
+        if self.replace: # rows selected out of view are no longer selected either
+            self.selected = {}
+            self.replace = False
+        for i, row in enumerate(self.shown):
+            if f'row{i}' in selection:
+                self.selected[self.key(row)] = row
+            else:
+                self.selected.pop(self.key(row), None)
+
+    def _cache(self, first, end):
+        """ make rows [first, end) available in self.rows """
+        cache_end = self.start + len(self.rows)
+        if self.rows and self.start <= first and end <= cache_end:
+            return
+        if self.rows and self.start <= first <= cache_end: # scrolling down, next page by key
+            self.rows += self.fetch(cache_end, end - cache_end + self.margin, self.rows[-1])
+            drop = first - self.margin - self.start
+            if drop > 0:
+                del self.rows[:drop]
+                self.start += drop
+        elif self.rows and first < self.start <= end: # scrolling up
+            start = max(0, first - self.margin)
+            self.rows[:0] = self.fetch(start, self.start - start, None)
+            self.start = start
+            del self.rows[end + self.margin - self.start:]
+        else: # jump
+            self.start = max(0, first - self.margin)
+            self.rows = self.fetch(self.start, end + self.margin - self.start, None)
+
+    def _show(self):
+        self.first = max(0, min(self.first, self.total - self.visible))
+        end = min(self.first + self.visible, self.total)
+        self._cache(self.first, end)
+        self.shown = self.rows[self.first - self.start:end - self.start]
+        items = len(self.tree.get_children())
+        for i in range(items, len(self.shown)):
+            self.tree.insert('', tk.END, iid=f'row{i}')
+        for i in range(len(self.shown), items):
+            self.tree.delete(f'row{i}')
+        selection = []
+        for i, row in enumerate(self.shown):
+            values, tags = self.render(row)
+            self.tree.item(f'row{i}', values=values, tags=tags)
+            if self.key(row) in self.selected:
+                selection.append(f'row{i}')
+        self.replace = False # the selection event of selection_set keeps the rows out of view
+        self.tree.selection_set(selection)
+        self.tree.yview_moveto(0)
+        if self.row_height is None and self.shown:
+            self.tree.after_idle(self._measure)
+        if self.total:
+            self.scrollbar.set(self.first / self.total, (self.first + len(self.shown)) / self.total)
+        else:
+            self.scrollbar.set(0, 1)
@@ -0,0 +1,142 @@
+import random
+
+class WeightedSampler:
+    """ Keys with non-negative integer weights kept in a Fenwick (binary indexed) tree: a weight update, a new key
+        and a weighted draw are O(log n), so sampling stays fast with hundreds of thousands of keys.
+        Keys set to weight 0 keep their slot and are never drawn """
+    def __init__(self, weights=None):
+        """
+        :param weights: {key: weight} to start with
+        """
+        self.keys = []
+        self.slots = {} # key -> 0-based position in keys
+        self.weights = []
+        self.tree = [0] # 1-based partial sums
+        self.total = 0
+        if weights:
+            self._build(weights)
+
+    def _build(self, weights):
+        # linear time construction, every node pushes its sum to its parent
+        self.keys = list(weights)
+        self.slots = {key: i for i, key in enumerate(self.keys)}
+        self.weights = [max(0, int(w)) for w in weights.values()]
+        tree = [0] + self.weights
+        n = len(self.weights)
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self.tree = tree
+        self.total = sum(self.weights)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def weight(self, key):
+        i = self.slots.get(key)
+        return self.weights[i] if i is not None else 0
+
+    def set(self, key, weight):
+        weight = max(0, int(weight))
+        i = self.slots.get(key)
+        if i is None:
+            if weight:
+                self._append(key, weight)
+            return
+        self._add(i, weight - self.weights[i])
+
+    def _add(self, i, delta):
+        if not delta:
+            return
+        self.weights[i] += delta
+        self.total += delta
+        i += 1
+        n = len(self.weights)
+        while i <= n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, i):
+        """ sum of the first i weights """
+        s = 0
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+
+    def _append(self, key, weight):
+        self.slots[key] = len(self.keys)
+        self.keys.append(key)
+        self.weights.append(weight)
+        i = len(self.weights)
+        # node i covers (i - lowbit(i), i]
+        self.tree.append(weight + self._prefix(i - 1) - self._prefix(i - (i & -i)))
+        self.total += weight
+
+    def _find(self, u):
+        """ 0-based position of the weight holding the point u of [0, total) """
+        pos = 0
+        n = len(self.weights)
+        step = 1 << n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= n and self.tree[nxt] <= u:
+                pos = nxt
+                u -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+    def sample(self, k, rng=random):
+        """ k distinct keys drawn in proportion to their weights (fewer when fewer keys have weight) """
+        drawn = []
+        try:
+            while len(drawn) < k and self.total > 0:
+                i = self._find(rng.randrange(self.total))
+                drawn.append((i, self.weights[i]))
+                self._add(i, -self.weights[i]) # out of the draw until restored
+        finally:
+            for i, w in drawn:
+                self._add(i, w)
+        return [self.keys[i] for i, _ in drawn]
+
+
+if __name__ == "__main__":
+    import time
+    from collections import Counter
+
+    # draws follow the weights, zero weights are never drawn
+    sampler = WeightedSampler({'a': 1, 'b': 2, 'c': 7, 'd': 0})
+    sampler.set('e', 10)
+    sampler.set('c', 0)
+    counts = Counter(key for _ in range(20000) for key in sampler.sample(1))
+    print(f"a:b:e = 1:2:10 -> {counts['a'] / 20000:.3f} {counts['b'] / 20000:.3f} {counts['e'] / 20000:.3f}, "
+          f"c {counts['c']}, d {counts['d']}")
+    assert not counts['c'] and not counts['d']
+    assert sorted(sampler.sample(10)) == ['a', 'b', 'e']
+    assert sampler.total == 13 and sampler._prefix(len(sampler.weights)) == 13
+
+    # against random.choices over the whole list, what a weighted pick costs without the tree
+    rng = random.Random(1)
+    for n in (1000, 100000, 1000000):
+        weights = {f'K{i}': rng.randint(1, 20) for i in range(n)}
+        start = time.perf_counter()
+        sampler = WeightedSampler(weights)
+        t_build = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(1000):
+            sampler.set(f'K{rng.randrange(n)}', rng.randint(0, 20))
+            sampler.set(f'N{i}', 3)
+        t_update = (time.perf_counter() - start) / 2000
+        start = time.perf_counter()
+        for _ in range(100):
+            sampler.sample(13)
+        t_sample = (time.perf_counter() - start) / 100
+        keys, values = list(weights), list(weights.values())
+        start = time.perf_counter()
+        for _ in range(5):
+            random.choices(keys, weights=values, k=13)
+        t_choices = (time.perf_counter() - start) / 5
+        assert sampler.total == sampler._prefix(len(sampler.weights))
+        print(f"{n:>8} keys: build {t_build * 1e3:7.1f} ms, update {t_update * 1e6:5.1f} us, "
+              f"sample 13 {t_sample * 1e6:6.1f} us (random.choices {t_choices * 1e6:8.0f} us)")
@@ -0,0 +1,190 @@
+""" Offline benchmark suite of the audio pipeline, results are written as json for before/after comparisons.
+
+    python benchmarks.py --output before.json
+    python benchmarks.py --output after.json --compare before.json
+
+No sound device is needed. Every benchmark reports the best of --repeat runs.
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+import timeit
+import numpy as np
+import helpers
+from CircularBuffer import CircularBuffer, SPSCRingBuffer
+from Mixer import Mixer
+from MorseSoundSource import MorseSoundSource, glyph_cache
+from NoiseSoundSource import NoiseSoundSource, BandNoiseGenerator
+
+MORSE_TABLE = 'configs/morse_table.json'
+SAMPLE_RATE = 44100
+BLOCK = 4410 # mixer push block, 0.1 s
+
+
+def best_time(fn, number, repeat):
+    """ best seconds per call """
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def result(benchmark, params, seconds, value, unit):
+    return {'benchmark': benchmark, 'params': params, 'seconds': seconds, 'value': value, 'unit': unit}
+
+
+def random_messages(length, count=20, seed=0):
+    rng = random.Random(seed)
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789/?'
+    words = []
+    for _ in range(count):
+        message = ''
+        while len(message) < length:
+            message += ''.join(rng.choice(alphabet) for _ in range(rng.randint(3, 6))) + ' '
+        words.append(message[:length].strip())
+    return words
+
+
+def bench_convert_to_signal(repeat):
+    results = []
+    for wpm in (15, 30, 60):
+        source = MorseSoundSource(MORSE_TABLE, wpm=wpm, sample_rate=SAMPLE_RATE)
+        for length in (5, 20, 80):
+            messages = random_messages(length)
+            seconds = best_time(lambda: [source._convert_to_signal(m) for m in messages], 10, repeat) / len(messages)
+            audio = sum(len(source._convert_to_signal(m)) for m in messages) / len(messages) / SAMPLE_RATE
+            results.append(result('convert_to_signal', {'wpm': wpm, 'chars': length}, seconds, audio / seconds, 'x real time'))
+    return results
+
+
+def bench_generate_arrays(repeat):
+    results = []
+    source = MorseSoundSource(MORSE_TABLE, wpm=30, sample_rate=SAMPLE_RATE)
+    source.play_string('cq test')
+
+    def cold():
+        glyph_cache.clear()
+        source._generate_arrays()
+    seconds = best_time(cold, 5, repeat)
+    results.append(result('generate_arrays', {'glyph_cache': 'cold'}, seconds, 1 / seconds, 'calls/s'))
+    seconds = best_time(source._generate_arrays, 20, repeat)
+    results.append(result('generate_arrays', {'glyph_cache': 'warm'}, seconds, 1 / seconds, 'calls/s'))
+    # speed change of a running source, every step renders new glyphs
+    glyph_cache.clear()
+    speeds = iter(range(10, 10 + 1000))
+    seconds = best_time(lambda: source.set_speed(next(speeds)), 5, repeat)
+    results.append(result('generate_arrays', {'rebuild': 'set_speed'}, seconds, 1 / seconds, 'calls/s'))
+    return results
+
+
+def bench_mix(repeat):
+    results = []
+    blocks = 20
+    message = 'cq test de nu6n ' * 40
+    for count in (1, 2, 4, 8, 16, 32, 64):
+        mixer = Mixer(sample_rate=SAMPLE_RATE)
+        for i in range(count):
+            source = MorseSoundSource(MORSE_TABLE, wpm=25 + i % 10, frequency=400 + 20 * i, sample_rate=SAMPLE_RATE,
+                                      volume=0.3)
+            source.play_string(message) # minutes of audio, no source runs dry
+            mixer.add_source(source)
+        seconds = best_time(lambda: [mixer.render(BLOCK) for _ in range(blocks)], 1, repeat) / blocks
+        results.append(result('mix', {'sources': count, 'block': BLOCK}, seconds, BLOCK / SAMPLE_RATE / seconds, 'x real time'))
+    return results
+
+
+def bench_noise(repeat):
+    results = []
+    rng = np.random.default_rng(0)
+    segments = {
+        'array': np.asarray(rng.normal(0, 0.3, SAMPLE_RATE * 10), dtype=np.float32),
+        'wav': helpers.WavReader('configs/qrn.wav'),
+        'band_noise': None,
+    }
+    out = np.empty(BLOCK, dtype=np.float32)
+    for name, segment in segments.items():
+        if segment is None:
+            noise = NoiseSoundSource(generator=BandNoiseGenerator(sample_rate=SAMPLE_RATE), sample_rate=SAMPLE_RATE)
+        else:
+            noise = NoiseSoundSource(audio_segment=segment, sample_rate=SAMPLE_RATE)
+        seconds = best_time(lambda: noise.render_into(out, BLOCK), 50, repeat)
+        results.append(result('noise_read', {'source': name, 'block': BLOCK}, seconds, BLOCK / SAMPLE_RATE / seconds, 'x real time'))
+    return results
+
+
+def bench_ring(repeat):
+    results = []
+    total = SAMPLE_RATE
+    for buffer_class in (CircularBuffer, SPSCRingBuffer):
+        for chunk in (64, 512, 4410):
+            ring = buffer_class(SAMPLE_RATE)
+            data = np.ones(chunk, dtype=np.float32)
+            out = np.empty(chunk, dtype=np.float32)
+            steps = total // chunk
+
+            def put_get():
+                for _ in range(steps): # single thread, the ring never fills or runs dry
+                    ring.put(data)
+                    if buffer_class is SPSCRingBuffer:
+                        ring.get_into(out)
+                    else:
+                        out[:] = ring.get(chunk)
+            seconds = best_time(put_get, 1, repeat) / (steps * chunk)
+            results.append(result('ring_put_get', {'ring': buffer_class.__name__, 'chunk': chunk}, seconds,
+                                  1e-6 / seconds, 'M samples/s'))
+    return results
+
+
+BENCHMARKS = {
+    'convert_to_signal': bench_convert_to_signal,
+    'generate_arrays': bench_generate_arrays,
+    'mix': bench_mix,
+    'noise_read': bench_noise,
+    'ring_put_get': bench_ring,
+}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': commit or None, 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'processor': platform.processor(),
+            'system': platform.platform()}
+
+
+def key(entry):
+    return entry['benchmark'], json.dumps(entry['params'], sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the audio pipeline offline")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help="earlier results to compare with")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='*', choices=sorted(BENCHMARKS), help="run a subset")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = {key(entry): entry for entry in json.load(file)['results']}
+
+    results = []
+    for name in args.only or BENCHMARKS:
+        for entry in BENCHMARKS[name](args.repeat):
+            results.append(entry)
+            params = ' '.join(f"{k}={v}" for k, v in entry['params'].items())
+            line = f"{name:<18} {params:<36} {entry['value']:12.1f} {entry['unit']}"
+            if key(entry) in baseline:
+                line += f"  ({entry['value'] / baseline[key(entry)]['value']:.2f}x baseline)"
+            print(line)
+
+    with open(args.output, 'w') as file:
+        json.dump({'environment': environment(), 'repeat': args.repeat, 'results': results}, file, indent=1)
+    print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+""" Parallel generator of labeled CW clips for decoder testing.
+
+    python generate_dataset.py dataset --clips 5000 --workers 8 --seed 1
+
+Every clip is a wav file with a json label holding the transcript, the rendering parameters
+and the start/end sample offsets of every character. A clip is fully determined by (seed, clip index).
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import helpers
+from DataSource import DataSource
+from Mixer import Mixer
+from MorseSoundSource import MorseSoundSource
+from NoiseSoundSource import NoiseSoundSource, BandNoiseGenerator
+
+# per worker state, loaded once by init_worker
+_corpora = {}
+_qrn = None
+_settings = None
+
+
+def init_worker(settings):
+    global _qrn, _settings
+    _settings = settings
+    _qrn = helpers.WavReader(os.path.join(settings['configs'], 'qrn.wav'))
+    policies_file = os.path.join(settings['configs'], 'message_policies.json')
+    for file_path in settings['sources']:
+        _corpora[os.path.basename(file_path)] = DataSource(file_path=file_path, num_words=1, policies_file=policies_file,
+                                                           pre_message=True, serial=True)
+
+
+def clip_parameters(rng, settings):
+    ranges = settings['ranges']
+    return {
+        'wpm': round(float(rng.uniform(*ranges['wpm'])), 1),
+        'tone': round(float(rng.uniform(*ranges['tone'])), 1),
+        'rise': round(float(rng.uniform(*ranges['rise'])), 3),
+        'qrn': round(float(rng.uniform(*ranges['qrn'])), 3),
+        'noise': round(float(rng.uniform(*ranges['noise'])), 3),
+        'lead': round(float(rng.uniform(0.1, 0.6)), 3), # silence before and after the message
+        'tail': round(float(rng.uniform(0.1, 0.6)), 3),
+    }
+
+
+def clip_message(rng, data_source, settings):
+    random.seed(int(rng.integers(1 << 63))) # default fields and serial numbers are drawn now, they follow the clip seed
+    msg = data_source.sample_message()
+    if settings['serial'] and rng.random() < 0.5:
+        msg = data_source.serial_number() + msg
+    if settings['pre_message'] and rng.random() < 0.5:
+        msg = data_source.pre_msgs_selection[rng.integers(len(data_source.pre_msgs_selection))] + msg
+    return ' '.join(msg.upper().split())
+
+
+def render_clip(index):
+    """ render clip number index into the output directory, returns its duration in seconds """
+    settings = _settings
+    rng = np.random.default_rng([settings['seed'], index])
+    source_name = sorted(_corpora)[rng.integers(len(_corpora))]
+    message = clip_message(rng, _corpora[source_name], settings)
+    params = clip_parameters(rng, settings)
+    sample_rate = _qrn.sample_rate
+
+    mixer = Mixer(sample_rate=sample_rate)
+    morse = MorseSoundSource(morse_mapping_filename=os.path.join(settings['configs'], 'morse_table.json'),
+                             wpm=params['wpm'], frequency=params['tone'], sample_rate=sample_rate,
+                             rise_time=params['rise'], volume=settings['volume'])
+    mixer.add_source(morse)
+    lead = int(params['lead'] * sample_rate)
+    marks, length = morse._message_marks(message)
+    total = lead + length + int(params['tail'] * sample_rate)
+    if params['qrn'] > 0:
+        qrn = NoiseSoundSource(audio_segment=_qrn, sample_rate=sample_rate, initial_volume=params['qrn'])
+        qrn.current_position = int(rng.integers(qrn.source_segment_length)) # random place in the recording
+        mixer.add_source(qrn)
+    if params['noise'] > 0:
+        noise = BandNoiseGenerator(sample_rate=sample_rate, seed=rng.integers(1 << 63))
+        mixer.add_source(NoiseSoundSource(generator=noise, sample_rate=sample_rate, initial_volume=params['noise']))
+
+    name = os.path.join(settings['output'], f"clip_{index:06d}")
+    with helpers.open_wav(name + '.wav', sample_rate) as wf:
+        helpers.write_wav_frames(wf, mixer.render(lead))
+        morse.play_string(message)
+        helpers.write_wav_frames(wf, mixer.render(total - lead))
+
+    label = {'seed': settings['seed'], 'index': index, 'source': source_name, 'transcript': message,
+             'sample_rate': sample_rate, 'samples': total, **params,
+             'chars': [{'char': symbol, 'start': lead + start, 'end': lead + end} for symbol, start, end in marks]}
+    with open(name + '.json', 'w') as file:
+        json.dump(label, file)
+    return float(total) / sample_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate labeled CW clips")
+    parser.add_argument('output', help="output directory")
+    parser.add_argument('--clips', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sources', nargs='*', default=None, help="message source files, all bundled ones by default")
+    parser.add_argument('--wpm', type=float, nargs=2, default=(15, 45))
+    parser.add_argument('--tone', type=float, nargs=2, default=(400, 900))
+    parser.add_argument('--rise', type=float, nargs=2, default=(0.05, 0.3))
+    parser.add_argument('--qrn', type=float, nargs=2, default=(0.0, 0.5))
+    parser.add_argument('--noise', type=float, nargs=2, default=(0.0, 0.5))
+    parser.add_argument('--volume', type=float, default=0.5)
+    parser.add_argument('--no-serial', dest='serial', action='store_false')
+    parser.add_argument('--no-pre-message', dest='pre_message', action='store_false')
+    parser.add_argument('--configs', default='configs', help="directory with morse_table.json, message_policies.json and qrn.wav")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    settings = {
+        'output': args.output, 'seed': args.seed, 'configs': args.configs, 'volume': args.volume,
+        'serial': args.serial, 'pre_message': args.pre_message,
+        'sources': args.sources or sorted(glob.glob(os.path.join('data_sources', '*.*'))),
+        'ranges': {'wpm': args.wpm, 'tone': args.tone, 'rise': args.rise, 'qrn': args.qrn, 'noise': args.noise},
+    }
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(settings,)) as pool:
+        durations = list(pool.map(render_clip, range(args.clips), chunksize=max(1, args.clips // (8 * args.workers))))
+    elapsed = time.perf_counter() - start
+    print(f"{args.clips} clips, {sum(durations):.0f} s of audio in {elapsed:.1f} s with {args.workers} workers "
+          f"({args.clips / elapsed:.1f} clips/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,92 @@ import shutil
 import json
 import os
 
+class WavReader:
+    """ Memory-mapped wav file, samples are converted to mono float32 only for the requested blocks.
+        Supports 8/16/24/32 bit PCM and 32/64 bit float, plain or WAVE_FORMAT_EXTENSIBLE """
+    PCM = 1
+    FLOAT = 3
+    EXTENSIBLE = 0xFFFE
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as file:
+            header = file.read(12)
+            if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+                raise ValueError(f"{file_path} is not a wav file")
+            fmt = None
+            data_offset = data_size = None
+            file_size = os.fstat(file.fileno()).st_size
+            while data_offset is None:
+                chunk = file.read(8)
+                if len(chunk) < 8:
+                    break
+                chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:], 'little')
+                if chunk_id == b'fmt ':
+                    fmt = file.read(chunk_size)
+                    file.seek(chunk_size % 2, os.SEEK_CUR) # chunks are word aligned
+                elif chunk_id == b'data':
+                    data_offset = file.tell()
+                    data_size = min(chunk_size, file_size - data_offset) # streamed files may carry a bogus size
+                else:
+                    file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+        if fmt is None or data_offset is None:
+            raise ValueError(f"{file_path} has no fmt or data chunk")
+        audio_format = int.from_bytes(fmt[0:2], 'little')
+        self.n_channels = int.from_bytes(fmt[2:4], 'little')
+        self.sample_rate = int.from_bytes(fmt[4:8], 'little')
+        self.sample_width = int.from_bytes(fmt[14:16], 'little') // 8
+        if audio_format == self.EXTENSIBLE:
+            audio_format = int.from_bytes(fmt[24:26], 'little') # first bytes of the sub format GUID
+        if audio_format == self.PCM and self.sample_width in (1, 2, 4):
+            dtype = {1: np.uint8, 2: '<i2', 4: '<i4'}[self.sample_width]
+            shape = (self.n_channels,)
+        elif audio_format == self.PCM and self.sample_width == 3:
+            dtype = np.uint8
+            shape = (self.n_channels, 3)
+        elif audio_format == self.FLOAT and self.sample_width in (4, 8):
+            dtype = {4: '<f4', 8: '<f8'}[self.sample_width]
+            shape = (self.n_channels,)
+        else:
+            raise ValueError(f"{file_path}: unsupported wav format {audio_format} with {8 * self.sample_width} bits")
+        self.audio_format = audio_format
+        self.n_frames = data_size // (self.n_channels * self.sample_width)
+        if self.n_frames:
+            self.data = np.memmap(file_path, dtype=dtype, mode='r', offset=data_offset, shape=(self.n_frames,) + shape)
+        else:
+            self.data = np.zeros((0,) + shape, dtype=dtype)
+
+    def __len__(self):
+        return self.n_frames
+
+    def read_into(self, out, start, frames):
+        """ convert frames starting at frame start into out[:frames] as mono float32 """
+        raw = self.data[start:start + frames]
+        if self.audio_format == self.FLOAT:
+            scale, offset = 1.0, 0.0
+        elif self.sample_width == 1:
+            scale, offset = 1.0 / 128, -128.0
+        elif self.sample_width == 3: # assemble little endian 24 bit samples and sign extend them
+            raw = raw.astype(np.int32)
+            raw = ((raw[..., 0] | (raw[..., 1] << 8) | (raw[..., 2] << 16)) << 8) >> 8
+            scale, offset = 1.0 / (1 << 23), 0.0
+        else:
+            scale, offset = 1.0 / (1 << (8 * self.sample_width - 1)), 0.0
+        block = out[:frames]
+        np.sum(raw, axis=1, dtype=np.float32, out=block) # mono mix of all channels
+        if offset:
+            block += offset * self.n_channels
+        block *= scale / self.n_channels
+        return block
+
+    def read(self, start=0, frames=None):
+        if frames is None:
+            frames = self.n_frames - start
+        return self.read_into(np.empty(frames, dtype=np.float32), start, frames)
+
 def read_wav(file_path):
-    with wave.open(file_path, 'rb') as wf:
-        sample_rate = wf.getframerate()
-        n_channels = wf.getnchannels()
-        n_frames = wf.getnframes()
-        audio_data = wf.readframes(n_frames)
-        audio_segment = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
-        if n_channels == 2:
-            audio_segment = audio_segment.reshape(-1, 2).mean(axis=1)
-    return audio_segment, sample_rate
+    reader = WavReader(file_path)
+    return reader.read(), reader.sample_rate
 
 
 def band_pass_filter(adata: np.ndarray, bandpass: tuple = (300, 900), sampling_rate: int = 44100) -> np.ndarray:
@@ -28,19 +104,23 @@ def band_pass_filter(adata: np.ndarray, bandpass: tuple = (300, 900), sampling_r
     adata_filtered = np.fft.ifft(fsig)
     return np.real(adata_filtered)
 
-def write_wav(file_path, audio_segment, sample_rate):
+def open_wav(file_path, sample_rate):
+    """ 16 bit mono wav file to be written in chunks with write_wav_frames """
+    wf = wave.open(file_path, 'wb')
+    wf.setnchannels(1)  # Mono channel
+    wf.setsampwidth(2)  # 2 bytes (16 bits)
+    wf.setframerate(sample_rate)
+    return wf
+
+def write_wav_frames(wf, audio_segment):
     # Ensure the audio data is in the correct format
-    audio_data = (audio_segment * 32768).astype(np.int16)
-
-    # Create a new wave file
-    with wave.open(file_path, 'wb') as wf:
-        # Set the parameters for the output file
-        wf.setnchannels(1)  # Mono channel
-        wf.setsampwidth(2)  # 2 bytes (16 bits)
-        wf.setframerate(sample_rate)
-        
-        # Write the audio data to the file
-        wf.writeframes(audio_data.tobytes())
+    audio_data = np.clip(audio_segment * 32768, -32768, 32767).astype(np.int16)
+    wf.writeframes(audio_data.tobytes())
+
+def write_wav(file_path, audio_segment, sample_rate):
+    # Create a new wave file and write the audio data to the file
+    with open_wav(file_path, sample_rate) as wf:
+        write_wav_frames(wf, audio_segment)
 
 L_min = -40  # Minimum loudness in dB
 L_max = 0    # Maximum loudness in dB
@@ -0,0 +1,89 @@
+""" Headless rendering of a training session into a wav file, no sound device or UI is needed.
+
+    python render_session.py data_sources/NAQPCW.txt session.wav --words 50 --wpm 30 --serial --qrn 0.2
+"""
+import argparse
+import os
+import random
+import time
+import numpy as np
+import helpers
+from DataSource import DataSource
+from Mixer import Mixer
+from MorseSoundSource import MorseSoundSource
+from NoiseSoundSource import NoiseSoundSource, BandNoiseGenerator
+
+
+def session_messages(data_source):
+    while True:
+        pre_msg, rst, ser_num, msg = data_source.get_next_word()
+        if msg is None:
+            return
+        yield pre_msg + rst + ser_num + msg
+
+
+def render_session(output_file, data_source, morse_source, mixer, gap=1.0, chunk=1.0):
+    """ render every message of the data source followed by gap seconds of silence,
+        the mix is written to disk chunk seconds at a time. Returns rendered duration in seconds """
+    sample_rate = mixer.sample_rate
+    chunk_samples = max(1, int(chunk * sample_rate))
+    total = 0
+    with helpers.open_wav(output_file, sample_rate) as wf:
+        for message in session_messages(data_source):
+            remaining = int(round((morse_source.play_string(message) + gap) * sample_rate))
+            while remaining > 0:
+                frames = min(chunk_samples, remaining)
+                helpers.write_wav_frames(wf, mixer.render(frames))
+                remaining -= frames
+                total += frames
+    return float(total) / sample_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a MorseCodeX training session into a wav file")
+    parser.add_argument('source', help="message source file: SCP, call history or plain text")
+    parser.add_argument('output', help="output wav file")
+    parser.add_argument('--words', type=int, default=50, help="number of messages")
+    parser.add_argument('--wpm', type=float, default=25)
+    parser.add_argument('--tone', type=float, default=650, help="tone frequency in Hz")
+    parser.add_argument('--rise', type=float, default=0.1, help="rise time relative to the dit length")
+    parser.add_argument('--volume', type=float, default=0.5)
+    parser.add_argument('--gap', type=float, default=1.0, help="silence after each message in seconds")
+    parser.add_argument('--pre-message', action='store_true', help="send tu/r/qsl before the message")
+    parser.add_argument('--rst', action='store_true')
+    parser.add_argument('--serial', action='store_true', help="send serial numbers")
+    parser.add_argument('--qrn', type=float, default=0.0, help="qrn volume")
+    parser.add_argument('--noise', type=float, default=0.0, help="band limited HF noise volume")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--configs', default='configs', help="directory with morse_table.json, message_policies.json and qrn.wav")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+
+    # qrn.wav governs the sample rate just like in the app
+    qrn_wav = helpers.WavReader(os.path.join(args.configs, 'qrn.wav'))
+    sample_rate = qrn_wav.sample_rate
+    mixer = Mixer(sample_rate=sample_rate)
+    morse_source = MorseSoundSource(morse_mapping_filename=os.path.join(args.configs, 'morse_table.json'), wpm=args.wpm,
+                                    frequency=args.tone, sample_rate=sample_rate, rise_time=args.rise, volume=args.volume)
+    mixer.add_source(morse_source)
+    noise_duration = float(len(qrn_wav)) / sample_rate
+    if args.qrn > 0:
+        mixer.add_source(NoiseSoundSource(audio_segment=qrn_wav, sample_rate=sample_rate,
+                                          duration=noise_duration, initial_volume=args.qrn))
+    if args.noise > 0:
+        mixer.add_source(NoiseSoundSource(generator=BandNoiseGenerator(sample_rate=sample_rate, seed=args.seed),
+                                          sample_rate=sample_rate, initial_volume=args.noise))
+
+    data_source = DataSource(file_path=args.source, num_words=args.words, pre_message=args.pre_message, rst=args.rst,
+                             serial=args.serial, policies_file=os.path.join(args.configs, 'message_policies.json'))
+    start = time.perf_counter()
+    duration = render_session(args.output, data_source, morse_source, mixer, gap=args.gap)
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {duration:.1f} s of audio in {elapsed:.2f} s ({duration / max(elapsed, 1e-9):.0f}x real time) into {args.output}")
+
+
+if __name__ == '__main__':
+    main()